@@ -0,0 +1,391 @@
+#!/usr/bin/env python
+"""
+Benchmark ``offtrac.etl`` on synthetic file databases: for each size a
+``db/`` tree is generated with the tickets, changelogs, fields and reports
+of ``offtrac.faketrac`` and committed, then timed with a full reindex into
+an empty SQLite database and an incremental one after some tickets
+changed. Sizes count change groups (a comment plus at most one field
+change). Each reindex runs in a child process so its peak RSS, and that of
+its worker pool and git, can be measured.
+
+Runs with ``python -mofftrac.benchetl --sizes 10000,100000 -o bench.json``,
+``--compare`` prints the speedup against the results of an earlier run.
+
+"""
+from __future__ import with_statement
+
+import os
+import sys
+import time
+import shutil
+import sqlite3
+import optparse
+import platform
+import resource
+import tempfile
+import multiprocessing
+from cStringIO import StringIO
+
+import simplejson as json
+
+from . import etl
+from . import model
+from . import dumptrac
+from .faketrac import FakeTracData, isotime, usec_isotime, parse_usec
+from .benchsync import GIT_IDENTITY
+
+DEFAULT_SIZES = (10000, 100000, 1000000)
+
+
+def write_ticket(writer, db, data, ticket_id):
+    """Write ``ticket_id`` of ``data`` like ``DB.pull`` would and forget
+    it, so that only the ticket being generated is kept in memory
+
+    """
+    writer.write(db.path_join('ticket', '%s.json' % (ticket_id,)),
+                 dumptrac.normalize_in_place(data.ticket_get(ticket_id)))
+    writer.write(db.path_join('changelog', '%s.json' % (ticket_id,)),
+                 dumptrac.normalize_in_place(
+                     data.ticket_changelog(ticket_id)))
+    del data.tickets[ticket_id]
+    del data.changelogs[ticket_id]
+
+
+def load_ticket(db, data, ticket_id):
+    """Read ``ticket_id`` back from ``db`` into ``data``"""
+    ticket_id, created, changed, props = db.load_json(
+        os.path.join('ticket', '%s.json' % (ticket_id,)))
+    props = dict(props)
+    del props['time']
+    del props['changetime']
+    data.tickets[ticket_id] = [ticket_id, parse_usec(created),
+                               parse_usec(changed), props]
+    data.changelogs[ticket_id] = [
+        [parse_usec(change[0])] + change[1:]
+        for change in db.load_json(
+            os.path.join('changelog', '%s.json' % (ticket_id,)))]
+
+
+def generate(root, tickets, changes, seed=0, writers=dumptrac.DEFAULT_WRITERS):
+    """Create a file database in ``root`` with ``tickets`` tickets of
+    ``changes`` change groups each and commit it. Returns the
+    ``FakeTracData`` for ``touch``.
+
+    """
+    data = FakeTracData(tickets=0, seed=seed)
+    db = dumptrac.DB(root)
+    db.init()
+    db.sync_jsondir(((report_id, {'title': title,
+                                  'sql': data.report_sql(report_id)})
+                     for report_id, title in data.reports), 'report')
+    for field in dumptrac.FIELDS:
+        db.sync_jsondir(((name, data.field_get(field, name))
+                         for name in data.field_get_all(field)),
+                        'field', field)
+    with dumptrac.JSONWriter(writers, write=db.write_json) as writer:
+        for ticket_id in xrange(1, tickets + 1):
+            data.new_ticket(ticket_id)
+            for _i in xrange(changes):
+                data.change_ticket(ticket_id)
+            write_ticket(writer, db, data, ticket_id)
+    db.metadata['recent'] = usec_isotime(data.now)
+    db.write_metadata()
+    db.checkpoint('generated {} tickets'.format(tickets))
+    return data
+
+
+def touch(root, data, tickets, count, writers=dumptrac.DEFAULT_WRITERS):
+    """Add a change group to ``count`` random tickets of the ``tickets``
+    in ``root``, create as many new ones and commit. Returns the number
+    of tickets written.
+
+    """
+    db = dumptrac.DB(root)
+    db.init()
+    ids = data.rand.sample(xrange(1, tickets + 1), min(count, tickets))
+    with dumptrac.JSONWriter(writers, write=db.write_json) as writer:
+        for ticket_id in ids:
+            load_ticket(db, data, ticket_id)
+            data.now = max(data.now, data.tickets[ticket_id][2])
+            data.change_ticket(ticket_id)
+            write_ticket(writer, db, data, ticket_id)
+        for ticket_id in xrange(tickets + 1, tickets + count + 1):
+            data.new_ticket(ticket_id)
+            write_ticket(writer, db, data, ticket_id)
+    db.metadata['recent'] = usec_isotime(data.now)
+    db.write_metadata()
+    db.checkpoint('touched {} tickets'.format(len(ids) + count))
+    return len(ids) + count
+
+
+def count_rows(path):
+    conn = sqlite3.connect(path)
+    try:
+        return sum(conn.execute('SELECT COUNT(*) FROM ' + table.name)
+                   .fetchone()[0]
+                   for table in model.metadata.sorted_tables
+                   if table.name != 'migrate_version')
+    finally:
+        conn.close()
+
+
+def bench_transforms(root, files):
+    """Time ``etl.build_rows`` on up to ``files`` JSON files of each
+    directory of the file database in ``root``, parsed before the clock
+    starts. Returns ``{table: {'rows': rows, 'seconds': seconds}}``.
+
+    """
+    db = dumptrac.DB(root)
+    imp = etl.ETL(db, None)
+    stats = {}
+    for dirname in dumptrac.DIRS:
+        items = []
+        for fn in sorted(db.json_glob(dirname))[:files]:
+            relpath = db.relpath(fn)
+            items.append((relpath, db.load_json(relpath)))
+        if not items:
+            continue
+        table_name = imp.lookup_class(items[0][0]).__table__.name
+        stat = stats.setdefault(table_name, {'rows': 0, 'seconds': 0.0})
+        t0 = time.time()
+        for relpath, data in items:
+            stat['rows'] += len(etl.build_rows(table_name, relpath, data))
+        stat['seconds'] += time.time() - t0
+    return stats
+
+
+def format_transforms(stats):
+    return ', '.join(
+        '{} {:.2f}us'.format(name, 1e6 * stat['seconds'] /
+                             max(stat['rows'], 1))
+        for name, stat in sorted(stats.iteritems()))
+
+
+def reindex_child(queue, root, options):
+    """``multiprocessing`` target: reindex the file database in ``root``
+    and put the measurements (or the error) on ``queue``
+
+    """
+    stdout = sys.stdout
+    if not options.verbose:
+        sys.stdout = StringIO()
+    try:
+        filedb = dumptrac.DB(root)
+        filedb.init()
+        engine = etl.get_engine(filedb)
+        model.metadata.create_all(engine)
+        cache = None
+        if options.cache:
+            cache = etl.open_row_cache(filedb)
+        imp = etl.ETL(filedb, etl.get_session_class(engine=engine),
+                      jobs=options.jobs, cache=cache, bulk=not options.orm,
+                      fast_load=not options.no_fast_load,
+                      shadow=not options.in_place)
+        t0 = time.time()
+        try:
+            imp.reindex()
+        finally:
+            if cache is not None:
+                cache.close()
+        elapsed = time.time() - t0
+        path = etl.sqlite_path(engine)
+        engine.dispose()
+        # The ORM session does not count its inserts
+        rows = None if options.orm else imp.rows_written
+        self_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        children_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        queue.put({
+            'seconds': elapsed,
+            'rows': rows,
+            'total_rows': count_rows(path),
+            'statements': imp.statements,
+            # ru_maxrss is in KiB on Linux
+            'peak_rss_kib': self_rss,
+            'peak_children_rss_kib': children_rss,
+            'sqlite_bytes': os.path.getsize(path),
+            'tables': [list(stat) for stat in imp.load_stats],
+            'phases': [list(stat) for stat in imp.phase_stats],
+        })
+    except Exception, e:
+        queue.put({'error': '{}: {}'.format(type(e).__name__, e)})
+        raise
+    finally:
+        sys.stdout = stdout
+
+
+def run_reindex(name, root, options, files):
+    queue = multiprocessing.Queue()
+    # Not a daemon: the ETL starts its own pool of workers
+    process = multiprocessing.Process(target=reindex_child,
+                                      args=(queue, root, options))
+    process.start()
+    res = queue.get()
+    process.join()
+    if 'error' in res:
+        raise RuntimeError('{} reindex failed: {}'.format(name, res['error']))
+    res['name'] = name
+    res['files'] = files
+    res['rows_per_second'] = None
+    if res['rows'] is not None:
+        res['rows_per_second'] = res['rows'] / max(res['seconds'], 1e-6)
+    return res
+
+
+def format_result(res):
+    rate = 'n/a'
+    if res['rows_per_second'] is not None:
+        rate = '{:.0f}'.format(res['rows_per_second'])
+    return ('{name:<12} {files:>8} files {seconds:>8.2f}s {rows!s:>9} rows '
+            '{rate:>9} rows/s {statements:>7} statements '
+            'peak RSS {rss:.1f} MiB (children {children_rss:.1f} MiB) '
+            'sqlite {mib:.1f} MiB').format(
+        rate=rate,
+        rss=res['peak_rss_kib'] / 1024.0,
+        children_rss=res['peak_children_rss_kib'] / 1024.0,
+        mib=res['sqlite_bytes'] / 1048576.0,
+        **res)
+
+
+def compare(results, old_results):
+    """Print the speedup of each run of ``results`` over the run with the
+    same size and name in ``old_results``
+
+    """
+    old = dict(((res['size'], run['name']), run)
+               for res in old_results['results'] for run in res['runs'])
+    old_transforms = dict((res['size'], res.get('transforms', {}))
+                          for res in old_results['results'])
+    for res in results['results']:
+        prev = old_transforms.get(res['size'], {})
+        for name, stat in sorted(res['transforms'].iteritems()):
+            if name not in prev:
+                continue
+            us = 1e6 * stat['seconds'] / max(stat['rows'], 1)
+            old_us = 1e6 * prev[name]['seconds'] / max(prev[name]['rows'], 1)
+            print ('{size:>8} transform {name:<14} {us:.2f}us vs '
+                   '{old_us:.2f}us per row ({speedup:.2f}x)').format(
+                size=res['size'], name=name, us=us, old_us=old_us,
+                speedup=old_us / max(us, 1e-9))
+        for run in res['runs']:
+            prev = old.get((res['size'], run['name']))
+            if prev is None:
+                continue
+            print ('{size:>8} {name:<12} {seconds:>8.2f}s vs {old:>8.2f}s '
+                   '({speedup:.2f}x), peak RSS {rss:.1f} vs {old_rss:.1f} '
+                   'MiB').format(
+                size=res['size'], name=run['name'],
+                seconds=run['seconds'], old=prev['seconds'],
+                speedup=prev['seconds'] / max(run['seconds'], 1e-6),
+                rss=run['peak_rss_kib'] / 1024.0,
+                old_rss=prev['peak_rss_kib'] / 1024.0)
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('-s', '--sizes',
+                      default=','.join(map(str, DEFAULT_SIZES)),
+                      help='comma separated change group counts '
+                           '(default: %default)')
+    parser.add_option('-c', '--changes', type='int', default=10,
+                      help='change groups per ticket (default: %default)')
+    parser.add_option('--touch', type='float', default=0.01,
+                      help='fraction of the tickets changed, and created, '
+                           'before the incremental reindex '
+                           '(default: %default)')
+    parser.add_option('--seed', type='int', default=0)
+    parser.add_option('--transform-files', type='int', default=2000,
+                      help='JSON files of each directory converted to rows '
+                           'to time the transformers (default: %default)')
+    parser.add_option('-j', '--jobs', type='int',
+                      default=dumptrac.default_jobs())
+    parser.add_option('--cache', action='store_true', default=False,
+                      help='use the row cache (empty before the full '
+                           'reindex)')
+    parser.add_option('--orm', action='store_true', default=False)
+    parser.add_option('--no-fast-load', action='store_true', default=False)
+    parser.add_option('--in-place', action='store_true', default=False)
+    parser.add_option('-o', '--output', metavar='FILE',
+                      help='write the results to FILE as JSON')
+    parser.add_option('--compare', metavar='FILE',
+                      help='print the speedup against the JSON results '
+                           'of an earlier run')
+    parser.add_option('--keep', metavar='DIR',
+                      help='generate the file databases under DIR and '
+                           'keep them')
+    parser.add_option('-v', '--verbose', action='store_true', default=False,
+                      help='show the output of the generator and the ETL')
+    (options, _args) = parser.parse_args(argv)
+    for k, v in GIT_IDENTITY.iteritems():
+        os.environ.setdefault(k, v)
+    sizes = [int(size) for size in options.sizes.split(',')]
+    results = {
+        'started': isotime(time.time()),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'options': {
+            'changes': options.changes,
+            'touch': options.touch,
+            'seed': options.seed,
+            'jobs': options.jobs,
+            'cache': options.cache,
+            'orm': options.orm,
+            'fast_load': not options.no_fast_load,
+            'shadow': not options.in_place,
+        },
+        'results': [],
+    }
+    parent = options.keep or tempfile.mkdtemp(prefix='offtrac-benchetl-')
+    try:
+        for size in sizes:
+            tickets = max(1, size // options.changes)
+            root = os.path.join(parent, str(size))
+            stdout = sys.stdout
+            if not options.verbose:
+                sys.stdout = StringIO()
+            try:
+                t0 = time.time()
+                data = generate(root, tickets, options.changes, options.seed)
+                generate_seconds = time.time() - t0
+            finally:
+                sys.stdout = stdout
+            print ('generated {} tickets with {} change groups in {:.2f}s'
+                   .format(tickets, tickets * options.changes,
+                           generate_seconds))
+            transforms = bench_transforms(root, options.transform_files)
+            print 'transform per row:', format_transforms(transforms)
+            full = run_reindex('full', root, options, 2 * tickets)
+            print format_result(full)
+            if not options.verbose:
+                sys.stdout = StringIO()
+            try:
+                touched = touch(root, data, tickets,
+                                max(1, int(tickets * options.touch)))
+            finally:
+                sys.stdout = stdout
+            incremental = run_reindex('incremental', root, options,
+                                      2 * touched)
+            print format_result(incremental)
+            results['results'].append({
+                'size': size,
+                'tickets': tickets,
+                'generate_seconds': generate_seconds,
+                'transforms': transforms,
+                'runs': [full, incremental],
+            })
+            if not options.keep:
+                shutil.rmtree(root)
+    finally:
+        if not options.keep:
+            shutil.rmtree(parent)
+    if options.output:
+        with open(options.output, 'wb') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+            f.write('\n')
+        print 'results written to', options.output
+    if options.compare:
+        with open(options.compare, 'rb') as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
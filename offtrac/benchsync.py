@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+"""
+Benchmark ``offtrac.dumptrac`` against a local ``offtrac.faketrac`` server:
+a full ``DB.pull`` into an empty file database followed by an incremental
+one after some tickets changed. The server runs in a child process so it
+does not compete with the client for the GIL.
+
+Runs with ``python -mofftrac.benchsync --tickets 5000 --latency 0.05``.
+
+"""
+from __future__ import with_statement
+
+import os
+import sys
+import time
+import shutil
+import urllib2
+import optparse
+import tempfile
+import multiprocessing
+from cStringIO import StringIO
+
+import simplejson as json
+
+from . import dumptrac
+from .faketrac import serve_child
+
+# DB.checkpoint commits, which needs an identity even on a bare machine
+GIT_IDENTITY = {
+    'GIT_AUTHOR_NAME': 'offtrac',
+    'GIT_AUTHOR_EMAIL': 'offtrac@localhost',
+    'GIT_COMMITTER_NAME': 'offtrac',
+    'GIT_COMMITTER_EMAIL': 'offtrac@localhost',
+}
+
+
+class FakeTracProcess(object):
+    """A ``offtrac.faketrac`` server running in a child process"""
+    def __init__(self, tickets, changes, latency, whole_seconds=False):
+        queue = multiprocessing.Queue()
+        self.process = multiprocessing.Process(
+            target=serve_child,
+            args=(queue, {'tickets': tickets, 'changes': changes,
+                          'whole_seconds': whole_seconds}, latency))
+        self.process.daemon = True
+        self.process.start()
+        self.url, self.tickets = queue.get()
+
+    def request(self, method, path):
+        req = urllib2.Request(self.url + path, data='' if method == 'POST'
+                              else None)
+        return json.load(urllib2.urlopen(req))
+
+    def stats(self):
+        return self.request('GET', '/_stats')
+
+    def touch(self, count):
+        return self.request('POST', '/_touch?count=%d' % (count,))
+
+    def stop(self):
+        self.process.terminate()
+        self.process.join()
+
+
+def run_pull(name, server, root, options, tickets, verbose=False):
+    controller = dumptrac.BatchController(
+        size=options.batch_size,
+        concurrency=1 if options.adaptive else options.concurrency,
+        max_concurrency=options.concurrency,
+        adaptive=options.adaptive)
+    t = dumptrac.Trac('bench', 'bench', server.url, controller=controller)
+    db = dumptrac.DB(root)
+    before = server.stats()
+    t0 = time.time()
+    stdout = sys.stdout
+    if not verbose:
+        sys.stdout = StringIO()
+    try:
+        db.init()
+        db.pull(t, writers=options.writers,
+                append_changelogs=not options.full_changelogs)
+    finally:
+        sys.stdout = stdout
+        t.close()
+    elapsed = time.time() - t0
+    after = server.stats()
+    return {
+        'name': name,
+        'tickets': tickets,
+        'seconds': elapsed,
+        'tickets_per_second': tickets / max(elapsed, 1e-6),
+        'round_trips': after['requests'] - before['requests'],
+        'response_bytes': after['bytes_sent'] - before['bytes_sent'],
+        'decoded_bytes': t.pool.bytes_decoded,
+        'connections': t.pool.connects,
+        'files_written': dumptrac.write_stats.written,
+        'files_unchanged': dumptrac.write_stats.skipped,
+        'checkpoint_seconds': db.checkpoint_seconds,
+        'maintenance_seconds': db.maintenance_seconds,
+    }
+
+
+def format_result(res):
+    return ('{name:<12} {tickets:>7} tickets {seconds:>8.2f}s '
+            '{tickets_per_second:>9.1f} tickets/s {round_trips:>6} '
+            'round trips {kib:>10.1f} KiB ({decoded_kib:.1f} KiB decoded) '
+            '{files_written} files written, {checkpoint_seconds:.2f}s in '
+            'checkpoint').format(
+        kib=res['response_bytes'] / 1024.0,
+        decoded_kib=res['decoded_bytes'] / 1024.0,
+        **res)
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('-t', '--tickets', type='int', default=2000)
+    parser.add_option('-c', '--changes', type='int', default=5,
+                      help='change groups per ticket (default: %default)')
+    parser.add_option('--touch', type='int', default=50,
+                      help='tickets changed and created before the '
+                           'incremental sync (default: %default)')
+    parser.add_option('-l', '--latency', type='float', default=0.05,
+                      help='seconds added to each response '
+                           '(default: %default)')
+    parser.add_option('-j', '--concurrency', type='int',
+                      default=dumptrac.DEFAULT_CONCURRENCY)
+    parser.add_option('-b', '--batch-size', type='int',
+                      default=dumptrac.MULTICALL_SIZE)
+    parser.add_option('-w', '--writers', type='int',
+                      default=dumptrac.DEFAULT_WRITERS)
+    parser.add_option('--adaptive', action='store_true', default=False)
+    parser.add_option('--full-changelogs', action='store_true',
+                      default=False)
+    parser.add_option('--whole-seconds', action='store_true', default=False,
+                      help='fake Trac times to the second, see '
+                           'offtrac.faketrac')
+    parser.add_option('--keep', metavar='DIR',
+                      help='write the file database to DIR and keep it')
+    parser.add_option('-v', '--verbose', action='store_true', default=False,
+                      help='show the output of DB.pull')
+    (options, _args) = parser.parse_args(argv)
+    for k, v in GIT_IDENTITY.iteritems():
+        os.environ.setdefault(k, v)
+    t0 = time.time()
+    server = FakeTracProcess(options.tickets, options.changes,
+                             options.latency, options.whole_seconds)
+    print 'started fake Trac with %d tickets in %.2fs' % (
+        server.tickets, time.time() - t0)
+    root = options.keep or tempfile.mkdtemp(prefix='offtrac-bench-')
+    try:
+        print format_result(run_pull('full', server, root, options,
+                                     server.tickets, options.verbose))
+        # Each touched ticket is changed once and as many are created, the
+        # boundary tickets of the previous sync are fetched again
+        touched = len(set(server.touch(options.touch)))
+        print format_result(run_pull('incremental', server, root, options,
+                                     touched, options.verbose))
+    finally:
+        server.stop()
+        if not options.keep:
+            shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main()
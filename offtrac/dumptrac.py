@@ -9,14 +9,24 @@
 from __future__ import with_statement
 
 import os
+import re
+import sys
 import glob
 import time
+import zlib
 import urllib
+import Queue
+import socket
 import getpass
+import threading
 import httplib
+import optparse
 import urlparse
 import itertools
+import multiprocessing
+from collections import deque, namedtuple
 from subprocess import Popen, PIPE
+from multiprocessing.pool import ThreadPool
 
 import simplejson as json
 
@@ -32,11 +42,36 @@ FIELDS = (
     'milestone',
 )
 DIRS = ('report', 'ticket', 'changelog') + tuple('field/' + f for f in FIELDS)
-IGNORES = ('*.db',)
+IGNORES = ('*.db', '*.db-journal')
 VERSION = 2
 MIN_RECENT = "2000-01-01T00:00:00"
 GIT = 'git'
 DEFAULT_PATH = './db'
+CLEAN_MARKER = 'offtrac-clean'
+SYNC_STATS = ('added', 'updated', 'unchanged', 'deleted')
+MULTICALL_SIZE = 100
+MIN_MULTICALL_SIZE = 5
+MAX_MULTICALL_SIZE = 1000
+DEFAULT_CONCURRENCY = 1
+BATCH_RETRIES = 4
+DEFAULT_WRITERS = 2
+WRITE_QUEUE_SIZE = 1000
+CHECKPOINT_EVERY = 1000
+# Tickets per round of ticket.get, tail and refetch calls when appending
+# to stored changelogs
+APPEND_WINDOW = 500
+# Tickets in the first round, to find out if the server finds the entries
+# at a change time at all
+APPEND_PROBE = 50
+CHANGELOG_STATS = ('appended', 'full', 'refetched')
+READ_SIZE = 64 * 1024
+# DB.maintain repacks past these, well below git gc --auto's defaults since
+# every sync adds a commit and its trees
+MAX_LOOSE_OBJECTS = 2000
+MAX_PACKS = 20
+DECODE_CHUNKSIZE = 64
+# Chunks queued or waiting to be consumed per parallel_imap worker
+CHUNKS_PER_JOB = 2
 
 
 class ProcessError(Exception):
@@ -47,9 +82,19 @@ class DBError(Exception):
     pass
 
 
-def call(args, **kw):
+class HTTPError(Exception):
+    def __init__(self, status, reason, body):
+        Exception.__init__(self, status, reason)
+        self.status = status
+        self.reason = reason
+        self.body = body
+
+
+def call(args, input=None, **kw):
+    if input is not None:
+        kw['stdin'] = PIPE
     p = Popen(args, stdout=PIPE, stderr=PIPE, **kw)
-    (stdout, stderr) = p.communicate()
+    (stdout, stderr) = p.communicate(input)
     return (p.returncode, stdout, stderr)
 
 
@@ -74,6 +119,233 @@ def get_http_connection(scheme, host):
     return cls(host)
 
 
+class ConnectionPool(object):
+    """Thread-safe pool of idle keep-alive HTTP connections to a single host.
+
+    Also keeps transfer metrics: requests made, bytes sent and received on
+    the wire, bytes after decompression, and connections opened (each one
+    a TLS handshake for https).
+
+    """
+    def __init__(self, scheme, host):
+        self.scheme = scheme
+        self.host = host
+        self.idle = Queue.LifoQueue()
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.connects = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.bytes_decoded = 0
+
+    def new_connection(self):
+        conn = get_http_connection(self.scheme, self.host)
+        connect = conn.connect
+
+        def counted_connect():
+            connect()
+            # Requests are sent as separate header and body writes, don't
+            # let Nagle's algorithm hold the body back for a delayed ACK
+            conn.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            with self.lock:
+                self.connects += 1
+
+        # httplib (re)connects through self.connect, including when a
+        # keep-alive connection was closed by the server
+        conn.connect = counted_connect
+        return conn
+
+    def get(self):
+        try:
+            return self.idle.get_nowait()
+        except Queue.Empty:
+            return self.new_connection()
+
+    def put(self, conn):
+        self.idle.put(conn)
+
+    def record(self, sent, received, decoded):
+        with self.lock:
+            self.requests += 1
+            self.bytes_sent += sent
+            self.bytes_received += received
+            self.bytes_decoded += decoded
+
+    def report(self):
+        return ('{} requests, {:.1f} KiB sent, {:.1f} KiB received '
+                '({:.1f} KiB decoded), {} connections opened').format(
+            self.requests, self.bytes_sent / 1024.0,
+            self.bytes_received / 1024.0, self.bytes_decoded / 1024.0,
+            self.connects)
+
+    def close(self):
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except Queue.Empty:
+                return
+
+
+def ordered_imap(pool, fn, iterable, window):
+    """Like ``itertools.imap(fn, iterable)`` but runs up to ``window()``
+    calls on ``pool`` at once. Results are yielded in input order.
+
+    """
+    pending = deque()
+    for item in iterable:
+        pending.append(pool.apply_async(fn, (item,)))
+        while len(pending) >= max(1, window()):
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+class CountingReader(object):
+    """File-like wrapper that counts the bytes read through it"""
+    def __init__(self, fp):
+        self.fp = fp
+        self.bytes = 0
+
+    def read(self, size=None):
+        # httplib treats a negative size as a byte count, not "read all"
+        if size is None:
+            data = self.fp.read()
+        else:
+            data = self.fp.read(size)
+        self.bytes += len(data)
+        return data
+
+
+class GzipReader(object):
+    """File-like wrapper that incrementally decompresses a gzip stream"""
+    def __init__(self, fp, read_size=READ_SIZE):
+        self.fp = fp
+        self.read_size = read_size
+        self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.buf = ''
+        self.eof = False
+
+    def read(self, size=None):
+        while not self.eof and (size is None or len(self.buf) < size):
+            chunk = self.fp.read(self.read_size)
+            if chunk:
+                self.buf += self.decompressor.decompress(chunk)
+            else:
+                self.buf += self.decompressor.flush()
+                self.eof = True
+        if size is None:
+            data, self.buf = self.buf, ''
+        else:
+            data, self.buf = self.buf[:size], self.buf[size:]
+        return data
+
+
+def gzip_compress(data):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+class BatchController(object):
+    """Chooses the multicall batch size and the number of batches in flight.
+
+    Each completed batch reports its size, latency and payload size. The
+    batch size follows the number of calls that fit in ``target_latency``
+    seconds and ``max_bytes`` of response, the concurrency grows by one
+    batch at a time while latency stays on target. Failures (5xx responses,
+    dropped connections) halve both and return an exponential backoff
+    delay. With ``adaptive=False`` the configured size and concurrency are
+    kept and only the failure backoff applies.
+
+    """
+    def __init__(self, size=MULTICALL_SIZE, concurrency=DEFAULT_CONCURRENCY,
+                 min_size=MIN_MULTICALL_SIZE, max_size=MAX_MULTICALL_SIZE,
+                 max_concurrency=None, adaptive=False,
+                 target_latency=5.0, max_bytes=8 * 1024 * 1024,
+                 min_delay=0.5, max_delay=30.0):
+        if max_concurrency is None:
+            max_concurrency = concurrency
+        self.adaptive = adaptive
+        self.min_size = min(min_size, size)
+        self.max_size = max(max_size, size)
+        self.max_concurrency = max(1, max_concurrency)
+        self.target_latency = target_latency
+        self.max_bytes = max_bytes
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.lock = threading.Lock()
+        self._size = float(size)
+        self._concurrency = float(min(concurrency, self.max_concurrency))
+        self.delay = 0.0
+        self.started = time.time()
+        self.calls = 0
+        self.batches = 0
+        self.bytes = 0
+        self.errors = 0
+
+    @property
+    def size(self):
+        return int(self._size)
+
+    @property
+    def concurrency(self):
+        return int(self._concurrency)
+
+    def clamp(self, size):
+        return max(self.min_size, min(self.max_size, size))
+
+    def success(self, ncalls, latency, nbytes):
+        with self.lock:
+            self.calls += ncalls
+            self.batches += 1
+            self.bytes += nbytes
+            self.delay = 0.0
+            if not self.adaptive or not ncalls:
+                return
+            per_call = max(latency, 1e-3) / ncalls
+            wanted = min(self.target_latency / per_call,
+                         self.max_bytes * ncalls / max(nbytes, 1))
+            # Move at most a factor of two per batch
+            self._size = self.clamp(
+                max(self._size / 2, min(self._size * 2, wanted)))
+            if latency > 2 * self.target_latency:
+                self._concurrency = max(1.0, self._concurrency - 1)
+            elif latency <= self.target_latency:
+                self._concurrency = min(
+                    float(self.max_concurrency),
+                    self._concurrency + 1.0 / self._concurrency)
+
+    def failure(self):
+        """Record a failed batch and return how long to wait before
+        retrying it.
+
+        """
+        with self.lock:
+            self.errors += 1
+            if self.adaptive:
+                # Without adaptive, success never grows them back
+                self._size = self.clamp(self._size / 2)
+                self._concurrency = max(1.0, self._concurrency / 2)
+            self.delay = min(self.max_delay,
+                             max(self.min_delay, 2 * self.delay))
+            return self.delay
+
+    def report(self):
+        elapsed = max(time.time() - self.started, 1e-3)
+        return ('{} calls in {} batches, {:.1f} KiB in {:.1f}s '
+                '({:.1f} calls/s, {:.1f} KiB/s), {} errors, '
+                'batch size {}, concurrency {}').format(
+            self.calls, self.batches, self.bytes / 1024.0, elapsed,
+            self.calls / elapsed, self.bytes / 1024.0 / elapsed,
+            self.errors, self.size, self.concurrency)
+
+
+def is_transient(e):
+    """True if a failed request may succeed if retried later"""
+    if isinstance(e, HTTPError):
+        return e.status >= 500
+    return isinstance(e, (httplib.BadStatusLine, socket.error))
+
+
 def auth_header(user, password):
     return ('Authorization', 'Basic ' + (user + ':' + password).encode('base64').strip())
 
@@ -100,12 +372,229 @@ def normalize_in_place(o):
     return o
 
 
-def write_json(fn, data):
+def jsonclass_hook(o):
+    """``object_hook`` that unwraps ``__jsonclass__`` datetimes while
+    decoding, the single pass equivalent of ``normalize_in_place``.
+
+    """
+    if '__jsonclass__' in o:
+        v = o['__jsonclass__']
+        assert v[0] == 'datetime'
+        return v[1]
+    return o
+
+
+class JSONStream(object):
+    """Decode JSON values one at a time from a file-like object without
+    reading the whole document into memory.
+
+    """
+    WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+    def __init__(self, fp, decoder, read_size=READ_SIZE):
+        self.fp = fp
+        self.decoder = decoder
+        self.read_size = read_size
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        if self.eof:
+            return False
+        # Read at least as much as is buffered so that re-decoding a
+        # large value is amortized linear
+        chunk = self.fp.read(max(self.read_size, len(self.buf) - self.pos))
+        if not chunk:
+            self.eof = True
+            return False
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """Skip whitespace and return the next character"""
+        while True:
+            self.pos = self.WHITESPACE.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.fill():
+                raise ValueError("Unexpected end of JSON document")
+
+    def expect(self, chars):
+        c = self.peek()
+        if c not in chars:
+            raise ValueError("Expected {!r} at {}, not {!r}".format(
+                chars, self.pos, c))
+        self.pos += 1
+        return c
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                obj, end = self.decoder.raw_decode(self.buf, self.pos)
+            except ValueError:
+                if self.fill():
+                    continue
+                raise
+            # A number at the end of the buffer may continue in the next read
+            if end == len(self.buf) and self.fill():
+                continue
+            self.pos = end
+            return obj
+
+
+def stream_rpc_response(fp, on_result, object_hook=jsonclass_hook):
+    """Parse a JSON-RPC response object from ``fp``, calling
+    ``on_result(item)`` for each element of the ``result`` array as soon as
+    it is decoded. Returns the response dict with ``result`` set to None
+    when it was streamed.
+
+    """
+    stream = JSONStream(fp, json.JSONDecoder(object_hook=object_hook))
+    res = {}
+    stream.expect('{')
+    if stream.peek() == '}':
+        return res
+    while True:
+        key = stream.value()
+        stream.expect(':')
+        if key == 'result' and stream.peek() == '[':
+            stream.pos += 1
+            if stream.peek() == ']':
+                stream.pos += 1
+            else:
+                while True:
+                    on_result(stream.value())
+                    if stream.expect(',]') == ']':
+                        break
+            res[key] = None
+        else:
+            res[key] = stream.value()
+        if stream.expect(',}') == '}':
+            return res
+
+
+class WriteStats(object):
+    """Thread-safe counters of files written and skipped by ``write_json``"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.written = 0
+        self.skipped = 0
+
+    def count(self, written):
+        with self.lock:
+            if written:
+                self.written += 1
+            else:
+                self.skipped += 1
+
+    def __str__(self):
+        return '{} written, {} unchanged'.format(self.written, self.skipped)
+
+
+write_stats = WriteStats()
+
+
+class JSONWriter(object):
+    """Serialize and write JSON files on background threads, fed through a
+    bounded queue so that fetching and writing overlap. The first error
+    raised by a writer is re-raised by ``write``, ``flush`` or ``close``.
+
+    """
+    def __init__(self, threads=DEFAULT_WRITERS, maxsize=WRITE_QUEUE_SIZE,
+                 write=None):
+        self.queue = Queue.Queue(maxsize)
+        self.write_json = write_json if write is None else write
+        self.error = None
+        self.threads = []
+        for _i in xrange(threads):
+            thread = threading.Thread(target=self.run)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close(check=exc_type is None)
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                if self.error is None:
+                    self.write_json(*item)
+            except Exception:
+                self.error = sys.exc_info()
+            finally:
+                self.queue.task_done()
+
+    def check(self):
+        if self.error is not None:
+            raise self.error[0], self.error[1], self.error[2]
+
+    def write(self, fn, data, if_changed=False):
+        self.check()
+        self.queue.put((fn, data, if_changed))
+
+    def flush(self):
+        """Wait until every queued file has been written"""
+        self.queue.join()
+        self.check()
+
+    def close(self, check=True):
+        for _thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        if check:
+            self.check()
+
+
+def dump_json(data):
+    return json.dumps(data, sort_keys=True, indent=1, separators=(',', ':'))
+
+
+def file_contents_equal(fn, s):
+    try:
+        if os.path.getsize(fn) != len(s):
+            return False
+        with open(fn, 'rb') as f:
+            return f.read() == s
+    except (IOError, OSError):
+        return False
+
+
+def write_json(fn, data, if_changed=False):
+    """Atomically write ``data`` to ``fn`` as canonical JSON. With
+    ``if_changed`` the write is skipped when ``fn`` already has exactly
+    these bytes. Returns True if the file was written.
+
+    """
+    s = dump_json(data)
+    if if_changed and file_contents_equal(fn, s):
+        write_stats.count(False)
+        return False
     dirname, basename = os.path.split(fn)
     tmpfn = os.path.join(dirname, '.' + basename)
     with open(tmpfn, 'wb') as f:
-        json.dump(data, f, sort_keys=True, indent=1, separators=(',', ':'))
+        f.write(s)
     os.rename(tmpfn, fn)
+    write_stats.count(True)
+    return True
+
+
+def format_sync_stats(stats):
+    return ', '.join('{} {}'.format(stats[k], k) for k in SYNC_STATS)
 
 
 def ticket_changed(lst):
@@ -113,6 +602,48 @@ def ticket_changed(lst):
     return changed
 
 
+def comment_number(change):
+    """The comment number of a ``comment`` changelog entry (``"3"``, or
+    ``"2.3"`` for a reply to comment 2), otherwise None
+
+    """
+    _time, _author, field, oldvalue, _newvalue, _permanent = change
+    if field != 'comment':
+        return None
+    try:
+        return int(unicode(oldvalue).rsplit('.', 1)[-1])
+    except ValueError:
+        return None
+
+
+def append_changelog(old, new):
+    """``old`` followed by ``new``, the entries at the ticket's last change
+    time, if they are the next change group (``old`` itself if they are
+    its last group). None when the whole changelog has to be fetched again:
+    ``new`` does not continue the comment numbers of ``old`` (there were
+    other changes in between), or the last group of ``old`` has
+    non-permanent entries that may have changed since.
+
+    """
+    if not new:
+        return None
+    if old:
+        last = old[-1][0]
+        tail = [change for change in old if change[0] == last]
+        if not all(change[5] for change in tail):
+            return None
+        if new[0][0] == last and new == tail:
+            # Nothing changed since the last sync, e.g. a boundary ticket
+            return old
+        if new[0][0] <= last:
+            return None
+    cnums = [cnum for cnum in map(comment_number, old) if cnum is not None]
+    expected = 1 + max(cnums) if cnums else 1
+    if expected not in map(comment_number, new):
+        return None
+    return old + new
+
+
 def url_safe_id(ident):
     s = unicode(ident)
     return urllib.quote_plus(s.encode('utf8'))
@@ -128,53 +659,217 @@ def parse_git_status(stdout):
     return results
 
 
+# A changed path from ``git diff --raw``. ``status`` is one letter
+# (A, M, D, R, ...), ``old_path`` is only set for renames and copies,
+# ``blob`` is the git blob id of ``path`` at HEAD or None.
+Change = namedtuple('Change', 'status path old_path blob')
+
+
+def iter_nul_fields(fp, read_size=READ_SIZE):
+    """Yield the NUL terminated fields read from ``fp``"""
+    buf = ''
+    while True:
+        chunk = fp.read(read_size)
+        if not chunk:
+            break
+        fields = (buf + chunk).split('\0')
+        buf = fields.pop()
+        for field in fields:
+            yield field
+    if buf:
+        yield buf
+
+
+def parse_git_changes(fields):
+    """Parse the fields of ``git diff -z --raw --no-abbrev`` into
+    ``Change`` records for JSON files
+
+    """
+    fields = iter(fields)
+    for info in fields:
+        _old_mode, _new_mode, _old_sha, sha, status = info[1:].split(' ')
+        blob = sha if sha.strip('0') else None
+        if status[:1] in ('R', 'C'):
+            old_path = next(fields)
+            path = next(fields)
+        else:
+            old_path = None
+            path = next(fields)
+        if path.endswith('.json') or (old_path or '').endswith('.json'):
+            yield Change(status[:1], path, old_path, blob)
+
+
+def expand_renames(changes):
+    """Replace each rename with a delete of the old path and an add of the
+    new one
+
+    """
+    for change in changes:
+        if change.status == 'R':
+            yield Change('D', change.old_path, None, None)
+            yield Change('A', change.path, None, change.blob)
+        else:
+            yield change
+
+
+def chunked(iterable, size):
+    """Yield lists of up to ``size`` items from ``iterable``"""
+    iterable = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterable, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def transform_json(item):
+    """Return ``(fn, data)`` for an ``(fn, s, transform)`` triple, for use
+    from a process pool. ``data`` is the JSON text ``s`` decoded (read from
+    ``fn`` when ``s`` is None), passed through ``transform(fn, data)`` when
+    given. ``transform`` must be picklable, e.g. a module level function.
+
+    """
+    fn, s, transform = item
+    if s is None:
+        with open(fn, 'rb') as f:
+            data = json.load(f)
+    else:
+        data = json.loads(s)
+    if transform is not None:
+        data = transform(fn, data)
+    return fn, data
+
+
+def default_jobs():
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+
+def map_chunk(item):
+    fn, chunk = item
+    return map(fn, chunk)
+
+
+def parallel_imap(fn, iterable, jobs, chunksize=DECODE_CHUNKSIZE):
+    """Like ``itertools.imap`` but on ``jobs`` processes, in order, with at
+    most ``jobs * CHUNKS_PER_JOB`` chunks of ``chunksize`` items in flight.
+    ``fn`` must be a module level function. Runs inline with fewer than two
+    jobs.
+
+    """
+    if jobs is None or jobs <= 1:
+        for result in itertools.imap(fn, iterable):
+            yield result
+        return
+    pool = multiprocessing.Pool(jobs)
+    try:
+        # Pool.imap would queue every chunk up front and keep every result
+        # the consumer has not reached yet, bound both to a few per job
+        chunks = ((fn, chunk) for chunk in chunked(iterable, chunksize))
+        for results in ordered_imap(pool, map_chunk, chunks,
+                                    lambda: jobs * CHUNKS_PER_JOB):
+            for result in results:
+                yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
 def path_id(path):
     return urllib.unquote_plus(os.path.basename(path).rpartition('.')[0])
 
 
 class Trac(object):
-    def __init__(self, user, password, url=TRAC_URL):
+    def __init__(self, user, password, url=TRAC_URL,
+                 concurrency=DEFAULT_CONCURRENCY, controller=None,
+                 gzip_requests=False):
         self.url = url
-        self.headers = dict([auth_header(user, password)])
-        self.conn = None
-
-    def http_request(self, method, path, body=None, headers={}, retries=3):
+        self.headers = dict([auth_header(user, password),
+                             ('Accept-Encoding', 'gzip')])
+        self.gzip_requests = gzip_requests
+        (scheme, netloc, _path,
+         _query, _fragment) = urlparse.urlsplit(url)
+        self.pool = ConnectionPool(scheme, netloc)
+        if controller is None:
+            controller = BatchController(concurrency=concurrency)
+        self.controller = controller
+        self._thread_pool = None
+
+    def close(self):
+        if self._thread_pool is not None:
+            self._thread_pool.close()
+            self._thread_pool.join()
+            self._thread_pool = None
+        self.pool.close()
+
+    def http_request(self, method, path, body=None, headers={}, retries=3,
+                     reader=None):
         """Make a HTTP ``method`` request to ``self.url + path``
         with optional body and headers.
 
-        Returns a dict with::
-
-            {
-                'status': int,
-                'reason': str,
-                'version': str,
-                'headers': dict, # keys are all lowercase
-                'raw_headers': [(key, value)],
-                'body': str,
-            }
+        Returns the response body, or ``reader(fp)`` if a reader is given,
+        where ``fp`` is a file-like object for the (decompressed) body. The
+        reader is called while the connection is checked out of the pool,
+        so it may consume the response incrementally.
 
         """
+        (_scheme, _netloc, path,
+         query, _fragment) = urlparse.urlsplit(self.url + path)
+        if query:
+            path = '%s?%s' % (path, query)
+        if body and self.gzip_requests:
+            body = gzip_compress(body)
+            headers = dict(headers, **{'Content-Encoding': 'gzip'})
         while True:
-            (scheme, netloc, path,
-             query, fragment) = urlparse.urlsplit(self.url + path)
-            if query:
-                path = '%s?%s' % (path, query)
-            if self.conn is None:
-                self.conn = get_http_connection(scheme, netloc)
-            self.conn.request(method, path, body, headers)
+            conn = self.pool.get()
+            response = None
             try:
-                response = self.conn.getresponse()
-                body = response.read()
-                headers = response.getheaders()
+                conn.request(method, path, body, headers)
+                response = conn.getresponse()
+                raw = CountingReader(response)
+                fp = CountingReader(
+                    GzipReader(raw)
+                    if response.getheader('content-encoding') == 'gzip'
+                    else raw)
+                if response.status >= 400:
+                    raise HTTPError(response.status, response.reason,
+                                    fp.read())
+                if reader is None:
+                    data = fp.read()
+                else:
+                    data = reader(fp)
+                # Drain any trailing bytes so the connection is reusable
+                raw.read()
             except Exception, e:
-                self.conn.close()
-                self.conn = None
+                # A connection that failed mid-request or mid-response is
+                # in an unknown state and must not go back to the pool
+                reusable = (response is not None and
+                            not isinstance(e, (socket.error,
+                                               httplib.HTTPException)))
+                if reusable:
+                    # The response may still be read to the end, which
+                    # keeps the connection alive (e.g. after a RPC error)
+                    try:
+                        raw.read()
+                    except Exception:
+                        reusable = False
+                if reusable:
+                    self.pool.put(conn)
+                else:
+                    conn.close()
                 if retries > 0 and isinstance(e, httplib.BadStatusLine):
                     retries -= 1
                     time.sleep(0.01)
                     continue
                 raise
-            return body
+            finally:
+                if response is not None:
+                    self.pool.record(len(body or ''), raw.bytes, fp.bytes)
+            self.pool.put(conn)
+            return data
 
     def http_get(self, path):
         res = self.http_request('GET',
@@ -193,26 +888,106 @@ class Trac(object):
                                headers)
         return json.loads(res)
 
-    def call(self, method, params):
-        res = normalize_in_place(self.raw_call(method, params))
-        if res['error']:
+    def call(self, method, params, on_result=None):
+        """Call ``method`` and return its result. Datetimes are unwrapped
+        while decoding.
+
+        If ``on_result`` is given the result must be an array, each element
+        is passed to ``on_result`` as soon as it is decoded and the return
+        value is None.
+
+        """
+        return self._call(method, params, on_result)[0]
+
+    def _call(self, method, params, on_result=None):
+        """Like ``call`` but returns ``(result, response_bytes)``"""
+        body = json.dumps({'method': method, 'params': params})
+        headers = dict(self.headers)
+        headers['Content-Type'] = 'application/json'
+
+        def reader(fp):
+            fp = CountingReader(fp)
+            if on_result is None:
+                res = json.load(fp, object_hook=jsonclass_hook)
+            else:
+                res = stream_rpc_response(fp, on_result)
+            return res, fp.bytes
+
+        res, nbytes = self.http_request('POST',
+                                        '/login/jsonrpc',
+                                        body,
+                                        headers,
+                                        reader=reader)
+        if res.get('error'):
             raise ValueError(res['error'])
-        return res['result']
+        return res.get('result'), nbytes
+
+    def imap(self, fn, iterable):
+        """Like ``itertools.imap(fn, iterable)``, but with up to
+        ``self.controller.concurrency`` calls in flight. Results are in
+        input order.
 
-    def imulticall(self, calls, size=100):
-        for i in xrange(0, len(calls), size):
-            for val in self.multicall(calls[i:i+size]):
+        """
+        controller = self.controller
+        if controller.max_concurrency <= 1:
+            return itertools.imap(fn, iterable)
+        if self._thread_pool is None:
+            self._thread_pool = ThreadPool(controller.max_concurrency)
+        return ordered_imap(self._thread_pool, fn, iterable,
+                            lambda: controller.concurrency)
+
+    def batches(self, calls, size=None):
+        """Split ``calls`` into batches, the size of each is decided by
+        the controller when the batch is about to be sent.
+
+        """
+        i = 0
+        while i < len(calls):
+            n = size or self.controller.size
+            yield calls[i:i+n]
+            i += n
+
+    def imulticall(self, calls, size=None):
+        for vals in self.imap(self.controlled_multicall,
+                              self.batches(calls, size)):
+            for val in vals:
                 yield val
 
+    def controlled_multicall(self, calls, retries=BATCH_RETRIES):
+        """``multicall`` that reports to ``self.controller`` and retries
+        transient failures after a backoff, splitting the batch in two.
+
+        """
+        t0 = time.time()
+        try:
+            rval, nbytes = self._multicall(calls)
+        except Exception, e:
+            if retries <= 0 or not is_transient(e):
+                raise
+            time.sleep(self.controller.failure())
+            if len(calls) == 1:
+                return self.controlled_multicall(calls, retries - 1)
+            half = len(calls) // 2
+            return (self.controlled_multicall(calls[:half], retries - 1) +
+                    self.controlled_multicall(calls[half:], retries - 1))
+        self.controller.success(len(calls), time.time() - t0, nbytes)
+        return rval
+
     def multicall(self, calls):
+        return self._multicall(calls)[0]
+
+    def _multicall(self, calls):
         calls = [{'method': method, 'params': params, 'id': 1 + i}
                  for i, (method, params) in enumerate(calls)]
         rval = [None] * len(calls)
-        for res in self.call('system.multicall', calls):
+
+        def on_result(res):
             if res['error']:
                 raise ValueError(res['error'])
             rval[res['id'] - 1] = res['result']
-        return rval
+
+        _result, nbytes = self._call('system.multicall', calls, on_result)
+        return rval, nbytes
 
     def recent_tickets(self, recent):
         return self.call('ticket.getRecentChanges', [jsondatetime(recent)])
@@ -254,19 +1029,121 @@ class Trac(object):
             self.imulticall([('ticket.changeLog', [ticket_id, 0])
                              for ticket_id in tickets]))
 
+    def yield_ticket_changelogs(self, tickets):
+        """Yield ``(ticket_id, ticket, changelog)`` with the ``ticket.get``
+        and ``ticket.changeLog`` calls for each ticket interleaved in the
+        same multicall batches.
+
+        """
+        calls = []
+        for ticket_id in tickets:
+            calls.append(('ticket.get', [ticket_id]))
+            calls.append(('ticket.changeLog', [ticket_id, 0]))
+        # Passing the same iterator twice pairs up consecutive results
+        results = self.imulticall(calls)
+        for ticket_id, info, changelog in itertools.izip(tickets,
+                                                         results,
+                                                         results):
+            yield ticket_id, info, changelog
+
+    def yield_appended_changelogs(self, tickets, stored, stats,
+                                  window=APPEND_WINDOW):
+        """Like ``yield_ticket_changelogs``, but when ``stored(ticket_id)``
+        returns the changelog already on disk only the entries at the
+        ticket's change time are fetched and appended to it (see
+        ``append_changelog``). The full changelog is fetched for new
+        tickets and when appending is not safe. ``stats`` counts these by
+        ``CHANGELOG_STATS``.
+
+        The entries at a change time are looked up by ``when``, which only
+        has whole seconds, and Trac 0.12 compares microsecond times. When
+        none of the tail calls of the first ``APPEND_PROBE`` tickets find
+        anything, the rest are fetched like ``yield_ticket_changelogs``.
+
+        """
+        tickets = list(tickets)
+        tails = 0
+        found = 0
+        start = 0
+        size = min(window, APPEND_PROBE)
+        while start < len(tickets):
+            group = tickets[start:start + size]
+            start += len(group)
+            size = window
+            infos = list(self.imulticall([('ticket.get', [ticket_id])
+                                          for ticket_id in group]))
+            olds = map(stored, group)
+            calls = []
+            for ticket_id, info, old in itertools.izip(group, infos, olds):
+                when = 0
+                if old is not None:
+                    when = jsondatetime(ticket_changed(info))
+                calls.append(('ticket.changeLog', [ticket_id, when]))
+            changelogs = list(self.imulticall(calls))
+            refetch = []
+            for i, old in enumerate(olds):
+                if old is None:
+                    stats['full'] += 1
+                    continue
+                tails += 1
+                if changelogs[i]:
+                    found += 1
+                changelog = append_changelog(old, changelogs[i])
+                if changelog is None:
+                    refetch.append(i)
+                else:
+                    changelogs[i] = changelog
+                    stats['appended'] += 1
+            stats['refetched'] += len(refetch)
+            results = self.imulticall([('ticket.changeLog', [group[i], 0])
+                                       for i in refetch])
+            for i, changelog in itertools.izip(refetch, results):
+                changelogs[i] = changelog
+            for row in itertools.izip(group, infos, changelogs):
+                yield row
+            if tails and not found and start < len(tickets):
+                print ('changelog tails came back empty, fetching whole '
+                       'changelogs')
+                stats['full'] += len(tickets) - start
+                for row in self.yield_ticket_changelogs(tickets[start:]):
+                    yield row
+                return
+
     def yield_reports(self, reports):
-        for report_id, title in reports:
+        def fetch_report(report):
+            report_id, title = report
             sql = self.http_get('/report?id=%s&format=sql' % (report_id,))
-            yield report_id, {'title': title, 'sql': sql.decode('utf8')}
+            return report_id, {'title': title, 'sql': sql.decode('utf8')}
+        return self.imap(fetch_report, reports)
 
 
 class DB(object):
+    ignores = IGNORES
+
     def __init__(self, root=DEFAULT_PATH):
         self.root = root
         self.metadata = {}
         self._git_head = None
+        # Paths (relative to root) written or removed since the last
+        # checkpoint, None when unknown and the whole tree must be scanned
+        self.dirty = None
+        self.checkpoint_seconds = 0.0
+        self.maintenance_seconds = 0.0
+        # None until known, the marker is removed before the first write
+        self._clean = None
 
     def init(self):
+        t0 = time.time()
+        if self.is_clean():
+            # The last run ended with a checkpoint and nothing has been
+            # written since, skip the whole-tree reset, scan and commit
+            self.dirty = set()
+            # Cheap, and a PackedDB adds pack/ to the ignores
+            self.gitignore()
+            self.read_metadata()
+            self.upgrade()
+            print 'init (clean) in {:.2f}s'.format(time.time() - t0)
+            return
         for dirname in map(self.path_join, DIRS):
             if not os.path.exists(dirname):
                 os.makedirs(dirname)
@@ -276,23 +1153,165 @@ class DB(object):
         self.read_metadata()
         self.upgrade()
         self.checkpoint()
+        print 'init (repair) in {:.2f}s'.format(time.time() - t0)
 
-    def git(self, *args):
-        return check_call([GIT] + list(args), cwd=self.root)
+    @property
+    def clean_marker(self):
+        return self.path_join('.git', CLEAN_MARKER)
 
-    def gitinit(self):
-        self.git('init')
+    def is_clean(self):
+        """True if the marker written by the last checkpoint names the
+        current HEAD
 
-    def checkpoint(self):
-        self._git_head = None
-        self.git('add', '-A')
-        # This will fail if there is nothing to commit
-        # TODO: handle this gracefully
+        """
         try:
-            self.git('commit', '-am', '{}'.format(self.recent))
-        except ProcessError:
+            with open(self.clean_marker, 'rb') as f:
+                marker = f.read().strip()
+        except IOError:
+            return False
+        (rc, stdout, _stderr) = call([GIT, 'rev-parse', '-q', '--verify',
+                                      'HEAD'], cwd=self.root)
+        return rc == 0 and stdout.strip() == marker
+
+    def mark_clean(self):
+        # Without a commit (e.g. no git identity) there is nothing to trust
+        if not self.has_head():
+            return
+        with open(self.clean_marker, 'wb') as f:
+            f.write(self.git_head + '\n')
+        self._clean = True
+
+    def mark_unclean(self):
+        """Called before anything in the tree changes"""
+        if self._clean is False:
+            return
+        self._clean = False
+        try:
+            os.remove(self.clean_marker)
+        except OSError:
             pass
 
+    def git(self, *args, **kw):
+        return check_call([GIT] + list(args), cwd=self.root, **kw)
+
+    def gitinit(self):
+        self.git('init')
+
+    def checkpoint(self, message=None):
+        if message is None:
+            message = '{}'.format(self.recent)
+        t0 = time.time()
+        if self.dirty is not None and self.has_head():
+            self.commit_paths(sorted(self.dirty), message)
+            how = 'staged {} paths'.format(len(self.dirty))
+        else:
+            self._git_head = None
+            self.git('add', '-A')
+            # This will fail if there is nothing to commit
+            # TODO: handle this gracefully
+            try:
+                self.git('commit', '-am', message)
+            except ProcessError:
+                pass
+            how = 'scanned the whole tree'
+        self.dirty = set()
+        self.mark_clean()
+        elapsed = time.time() - t0
+        self.checkpoint_seconds += elapsed
+        print 'checkpoint {} in {:.2f}s'.format(how, elapsed)
+
+    def object_stats(self):
+        """``git count-objects -v`` as a dict of ints (count, size, in-pack,
+        packs, size-pack, ...), sizes in KiB
+
+        """
+        stats = {}
+        for line in self.git('count-objects', '-v')[1].splitlines():
+            key, _sep, value = line.partition(':')
+            try:
+                stats[key] = int(value)
+            except ValueError:
+                pass
+        return stats
+
+    def has_commit_graph(self):
+        info = self.path_join('.git', 'objects', 'info')
+        return (os.path.exists(os.path.join(info, 'commit-graph')) or
+                os.path.exists(os.path.join(info, 'commit-graphs')))
+
+    def maintain(self, max_loose_objects=MAX_LOOSE_OBJECTS,
+                 max_packs=MAX_PACKS):
+        """Keep ``git diff`` and ``rev-parse`` fast as checkpoints pile up:
+        pack loose objects once there are ``max_loose_objects`` of them,
+        consolidate the packs past ``max_packs``, and extend the
+        commit-graph after a repack or when there is none.
+
+        """
+        t0 = time.time()
+        stats = self.object_stats()
+        done = []
+        if stats.get('packs', 0) >= max_packs:
+            self.git('repack', '-a', '-d', '-q')
+            done.append('repacked everything')
+        elif stats.get('count', 0) >= max_loose_objects:
+            # Only the loose objects go into a new pack
+            self.git('repack', '-d', '-q')
+            done.append('packed loose objects')
+        if self.has_head() and (done or not self.has_commit_graph()):
+            try:
+                self.git('commit-graph', 'write', '--reachable', '--split')
+                done.append('wrote commit-graph')
+            except ProcessError:
+                # git older than 2.19
+                pass
+        if done:
+            stats = self.object_stats()
+        elapsed = time.time() - t0
+        self.maintenance_seconds += elapsed
+        print ('git: {} loose objects, {} packs ({:.1f} MiB){} in {:.2f}s'
+               .format(stats.get('count', 0), stats.get('packs', 0),
+                       stats.get('size-pack', 0) / 1024.0,
+                       ''.join(', ' + action for action in done), elapsed))
+
+    def has_head(self):
+        return call([GIT, 'rev-parse', '-q', '--verify', 'HEAD'],
+                    cwd=self.root)[0] == 0
+
+    def commit_paths(self, paths, message):
+        """Commit the current contents of ``paths`` on top of HEAD, without
+        looking at any other file in the tree.
+
+        """
+        if paths:
+            self.git('update-index', '--add', '--remove', '-z', '--stdin',
+                     input=''.join(path + '\0' for path in paths))
+        tree = self.git('write-tree')[1].strip()
+        parent = self.git_head
+        if tree == self.git('rev-parse', parent + '^{tree}')[1].strip():
+            return
+        commit = self.git('commit-tree', tree, '-p', parent,
+                          input=message + '\n')[1].strip()
+        self.git('update-ref', '-m', 'commit: ' + message,
+                 'HEAD', commit, parent)
+        self._git_head = commit
+
+    def relpath(self, fn):
+        return os.path.relpath(fn, self.root)
+
+    def write_json(self, fn, data, if_changed=False):
+        """``write_json`` that records ``fn`` for the next checkpoint"""
+        self.mark_unclean()
+        written = write_json(fn, data, if_changed)
+        if written and self.dirty is not None:
+            self.dirty.add(self.relpath(fn))
+        return written
+
+    def remove(self, fn):
+        self.mark_unclean()
+        os.remove(fn)
+        if self.dirty is not None:
+            self.dirty.add(self.relpath(fn))
+
     def cleanup(self):
         # This will fail if the repo has no commits
         try:
@@ -306,7 +1325,7 @@ class DB(object):
 
     def gitignore(self):
         fn = self.path_join('.gitignore')
-        ignores = set([ignore + '\n' for ignore in IGNORES])
+        ignores = set([ignore + '\n' for ignore in self.ignores])
         try:
             with open(fn, 'rb') as f:
                 for l in f:
@@ -315,9 +1334,12 @@ class DB(object):
             pass
         if not ignores:
             return
+        self.mark_unclean()
         with open(fn, 'ab') as f:
             for ignore in sorted(ignores):
                 f.write(ignore)
+        if self.dirty is not None:
+            self.dirty.add('.gitignore')
 
     def read_metadata(self):
         try:
@@ -327,7 +1349,27 @@ class DB(object):
             pass
 
     def write_metadata(self):
-        write_json(self.path_join('db.json'), self.metadata)
+        self.write_json(self.path_join('db.json'), self.metadata,
+                        if_changed=True)
+
+    def read_resume(self):
+        """Progress of an interrupted ticket sync, or None"""
+        try:
+            with open(self.path_join('resume.json'), 'rb') as f:
+                return json.load(f)
+        except IOError:
+            return None
+
+    def write_resume(self, since, recent, done):
+        self.write_json(self.path_join('resume.json'),
+                        {'since': since, 'recent': recent,
+                         'done': sorted(done)})
+
+    def clear_resume(self):
+        try:
+            self.remove(self.path_join('resume.json'))
+        except OSError:
+            pass
 
     def upgrade(self):
         while True:
@@ -350,11 +1392,57 @@ class DB(object):
         with open(self.path_join(fn), 'rb') as f:
             return json.load(f)
 
-    def iter_jsondir(self, dirname):
-        for fn in self.json_glob(dirname):
-            with open(fn, 'rb') as f:
-                data = json.load(f)
-            yield fn, data
+    def iter_jsondir(self, dirname, jobs=None, transform=None):
+        """Yield ``(fn, data)`` for the JSON files in ``dirname`` sorted by
+        name, decoding them on ``jobs`` processes when given. With
+        ``transform`` the processes yield ``transform(fn, data)`` instead
+        of ``data`` (see ``transform_json``).
+
+        """
+        return self.iter_json_files(sorted(self.json_glob(dirname)), jobs,
+                                    transform)
+
+    def iter_json_files(self, fns, jobs=None, transform=None):
+        """Yield ``(fn, data)`` for each of ``fns`` in order, like
+        ``iter_jsondir``
+
+        """
+        if len(fns) < DECODE_CHUNKSIZE:
+            jobs = None
+        return parallel_imap(transform_json,
+                             ((fn, None, transform) for fn in fns), jobs)
+
+    def blob_ids(self, *args):
+        """Map the path of each JSON file under ``args`` (relative to root)
+        to its git blob id at HEAD. Files that differ from HEAD in the
+        working tree are left out.
+
+        """
+        prefix = os.path.join(*args) + '/' if args else ''
+        blobs = {}
+        stdout = self.git('ls-tree', '-r', '-z', 'HEAD', '--',
+                          prefix or '.')[1]
+        for entry in stdout.split('\0'):
+            if not entry:
+                continue
+            info, path = entry.split('\t', 1)
+            _mode, kind, sha = info.split(' ')
+            if kind == 'blob' and path.endswith('.json'):
+                blobs[path] = sha
+        if blobs and not self.is_clean():
+            for path in self.dirty_files(*args):
+                blobs.pop(path, None)
+        return blobs
+
+    def dirty_files(self, *args):
+        """The paths under ``args`` (relative to root) that differ from
+        HEAD in the working tree
+
+        """
+        prefix = os.path.join(*args) + '/' if args else ''
+        stdout = self.git('diff', '-z', '--name-only', 'HEAD', '--',
+                          prefix or '.')[1]
+        return [path for path in stdout.split('\0') if path]
 
     def read_tickets(self):
         for _fn, data in self.iter_jsondir('ticket'):
@@ -371,49 +1459,152 @@ class DB(object):
         self._git_head = self.git('rev-parse', 'HEAD')[1].rstrip()
         return self._git_head
 
+    def iter_changes(self, ver):
+        """Stream the ``Change`` records for JSON files between ``ver`` and
+        HEAD from ``git diff -z``, without buffering the whole diff.
+
+        """
+        args = [GIT, 'diff', '-z', '-M', '--raw', '--no-abbrev',
+                '{}...HEAD'.format(ver)]
+        p = Popen(args, stdout=PIPE, cwd=self.root)
+        try:
+            for change in parse_git_changes(iter_nul_fields(p.stdout)):
+                yield change
+        finally:
+            p.stdout.close()
+            rc = p.wait()
+        if rc:
+            raise ProcessError("{!r} returned {}".format(args, rc))
+
     def changed_files(self, ver):
-        return parse_git_status(
-            self.git('diff', '--name-status', '{}...HEAD'.format(ver))[1])
+        return [(change.status, change.path)
+                for change in expand_renames(self.iter_changes(ver))]
 
     def nuke(self, *args):
         for fn in self.json_glob(*args):
-            os.remove(fn)
+            self.remove(fn)
+
+    def sync_jsondir(self, items, *args):
+        """Make the JSON files in directory ``args`` match ``items``, an
+        iterable of ``(id, data)``. Files are only written when their
+        content differs, and only files with an id not in ``items`` are
+        removed. Returns a dict of counts keyed by ``SYNC_STATS``.
+
+        """
+        stale = set(self.json_glob(*args))
+        stats = dict.fromkeys(SYNC_STATS, 0)
+        for item_id, data in items:
+            fn = self.path_join(*(args + ('%s.json' % url_safe_id(item_id),)))
+            if fn in stale:
+                stale.discard(fn)
+                if self.write_json(fn, data, if_changed=True):
+                    stats['updated'] += 1
+                else:
+                    stats['unchanged'] += 1
+            else:
+                self.write_json(fn, data)
+                stats['added'] += 1
+        for fn in stale:
+            self.remove(fn)
+            stats['deleted'] += 1
+        return stats
+
+    def stored_changelog(self, ticket_id):
+        """The changelog of ``ticket_id`` on disk, or None"""
+        try:
+            return self.load_json(os.path.join('changelog',
+                                               '%s.json' % (ticket_id,)))
+        except (IOError, KeyError, ValueError):
+            return None
+
+    def pull(self, t, writers=DEFAULT_WRITERS,
+             checkpoint_every=CHECKPOINT_EVERY, maintain=True,
+             append_changelogs=True):
+        """Sync everything from ``t``. Every ``checkpoint_every`` tickets the
+        ticket sync progress is committed to ``resume.json``, so a run that
+        is interrupted continues from there instead of from the old
+        ``recent`` watermark. With ``append_changelogs`` only the new
+        entries of stored changelogs are fetched.
 
-    def pull(self, t):
+        """
+        write_stats.reset()
         # Reports
         print 'syncing reports'
-        self.nuke('report')
         reports = t.report_list()
-        for report_id, info in t.yield_reports(reports):
-            safe_id = url_safe_id(report_id)
-            write_json(self.path_join('report', '%s.json' % (safe_id,)), info)
+        stats = self.sync_jsondir(t.yield_reports(reports), 'report')
+        print 'reports:', format_sync_stats(stats)
         # Fields
+        totals = dict.fromkeys(SYNC_STATS, 0)
         for field_name in FIELDS:
-            print 'syncing', field_name
-            self.nuke('field', field_name)
-            for field_id, info in t.yield_field(field_name):
-                safe_id = url_safe_id(field_id)
-                write_json(self.path_join('field',
-                                          field_name,
-                                          '%s.json' % (safe_id,)),
-                           info)
+            stats = self.sync_jsondir(t.yield_field(field_name),
+                                      'field', field_name)
+            print 'syncing {}: {}'.format(field_name, format_sync_stats(stats))
+            for k, v in stats.iteritems():
+                totals[k] += v
+        print 'fields: {} changed, {} unchanged'.format(
+            totals['added'] + totals['updated'] + totals['deleted'],
+            totals['unchanged'])
         # Changed tickets
-        print 'fetching changed ticket ids since', self.recent
-        recent_tickets = t.recent_tickets(self.recent)
-        print 'fetching metadata for %d tickets' % (len(recent_tickets),)
-        new_recent = self.recent
-        for ticket_id, info in t.yield_tickets(recent_tickets):
-            new_recent = max(new_recent, ticket_changed(info))
-            write_json(self.path_join('ticket', '%s.json' % (ticket_id,)),
-                       info)
-        print 'fetching changelog for %d tickets' % (len(recent_tickets),)
-        for ticket_id, info in t.yield_changelogs(recent_tickets):
-            write_json(self.path_join('changelog', '%s.json' % (ticket_id,)),
-                       info)
+        since = self.recent
+        print 'fetching changed ticket ids since', since
+        recent_tickets = t.recent_tickets(since)
+        new_recent = since
+        done = set()
+        resume = self.read_resume()
+        if resume is not None and resume['since'] == since:
+            # Tickets that changed after the interrupted run fetched them
+            # are at or after its partial watermark
+            new_recent = resume['recent']
+            done = set(resume['done']).difference(t.recent_tickets(new_recent))
+            recent_tickets = [ticket_id for ticket_id in recent_tickets
+                              if ticket_id not in done]
+            print 'resuming interrupted sync up to {}, {} tickets done'.format(
+                new_recent, len(done))
+        print 'fetching metadata and changelog for %d tickets' % (
+            len(recent_tickets),)
+        changelog_stats = dict.fromkeys(CHANGELOG_STATS, 0)
+        if append_changelogs:
+            rows = t.yield_appended_changelogs(
+                recent_tickets, self.stored_changelog, changelog_stats)
+        else:
+            rows = t.yield_ticket_changelogs(recent_tickets)
+        with JSONWriter(writers, write=self.write_json) as writer:
+            for n, (ticket_id, info, changelog) in enumerate(rows, 1):
+                new_recent = max(new_recent, ticket_changed(info))
+                writer.write(
+                    self.path_join('ticket', '%s.json' % (ticket_id,)),
+                    info, if_changed=True)
+                writer.write(
+                    self.path_join('changelog', '%s.json' % (ticket_id,)),
+                    changelog, if_changed=True)
+                done.add(ticket_id)
+                if (checkpoint_every and n % checkpoint_every == 0 and
+                        n < len(recent_tickets)):
+                    writer.flush()
+                    self.write_resume(since, new_recent, done)
+                    self.checkpoint('{} (partial, {} of {} tickets)'.format(
+                        new_recent, n, len(recent_tickets)))
         self.metadata['recent'] = new_recent
         self.write_metadata()
+        self.clear_resume()
         print 'synced up to', self.recent
+        if append_changelogs:
+            print ('changelogs: {appended} appended, {full} full, '
+                   '{refetched} fetched again').format(**changelog_stats)
+        print 'rpc throughput:', t.controller.report()
+        print 'http:', t.pool.report()
+        print 'files:', write_stats
         self.checkpoint()
+        if maintain:
+            self.maintain()
+
+
+def open_db(root=DEFAULT_PATH):
+    """The ``DB`` for ``root``, a ``packdb.PackedDB`` if it has a pack"""
+    from . import packdb
+    if packdb.has_pack(root):
+        return packdb.PackedDB(root)
+    return DB(root)
 
 
 def keychain_auth(url):
@@ -426,12 +1617,63 @@ def keychain_auth(url):
     return username, password
 
 
-def main():
+def main(argv=None):
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('-j', '--concurrency', type='int',
+                      default=DEFAULT_CONCURRENCY,
+                      help='number of HTTP connections used to fetch '
+                           'multicall batches in parallel (default: %default)')
+    parser.add_option('-b', '--batch-size', type='int',
+                      default=MULTICALL_SIZE,
+                      help='calls per system.multicall (default: %default)')
+    parser.add_option('-w', '--writers', type='int',
+                      default=DEFAULT_WRITERS,
+                      help='number of threads writing ticket and changelog '
+                           'files (default: %default)')
+    parser.add_option('--checkpoint-every', type='int',
+                      default=CHECKPOINT_EVERY, metavar='N',
+                      help='commit ticket sync progress every N tickets so '
+                           'an interrupted sync can resume, 0 to disable '
+                           '(default: %default)')
+    parser.add_option('--gzip-requests', action='store_true', default=False,
+                      help='gzip request bodies (the server must support '
+                           'Content-Encoding: gzip requests)')
+    parser.add_option('--adaptive', action='store_true', default=False,
+                      help='adapt the batch size (between {} and {}) and '
+                           'the concurrency (up to --concurrency) to the '
+                           'observed latency'.format(MIN_MULTICALL_SIZE,
+                                                     MAX_MULTICALL_SIZE))
+    parser.add_option('--full-changelogs', action='store_true',
+                      default=False,
+                      help='fetch the whole changelog of every changed '
+                           'ticket instead of appending the new entries')
+    parser.add_option('--no-maintenance', action='store_true', default=False,
+                      help='do not repack the git repository or update its '
+                           'commit-graph after the sync')
+    (options, _args) = parser.parse_args(argv)
+    if options.concurrency < 1:
+        parser.error('--concurrency must be at least 1')
+    if options.batch_size < 1:
+        parser.error('--batch-size must be at least 1')
+    if options.writers < 1:
+        parser.error('--writers must be at least 1')
+    controller = BatchController(
+        size=options.batch_size,
+        concurrency=1 if options.adaptive else options.concurrency,
+        max_concurrency=options.concurrency,
+        adaptive=options.adaptive)
     user, password = keychain_auth(TRAC_URL)
-    t = Trac(user, password, TRAC_URL)
-    db = DB()
+    t = Trac(user, password, TRAC_URL, controller=controller,
+             gzip_requests=options.gzip_requests)
+    db = open_db()
     db.init()
-    db.pull(t)
+    try:
+        db.pull(t, writers=options.writers,
+                checkpoint_every=options.checkpoint_every,
+                maintain=not options.no_maintenance,
+                append_changelogs=not options.full_changelogs)
+    finally:
+        t.close()
 
 
 if __name__ == '__main__':
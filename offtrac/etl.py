@@ -1,16 +1,39 @@
 import os
+import re
+import sys
 import time
 import calendar
+import optparse
+import functools
+import itertools
+from collections import defaultdict
 
-from sqlalchemy import create_engine, and_
+from sqlalchemy import create_engine, and_, bindparam
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
 
 from . import model
 from . import dumptrac
-from .dumptrac import path_id
+from .dumptrac import path_id, chunked, expand_renames
+from .rowcache import RowCache, DEFAULT_MAX_BYTES
 
 Base = declarative_base()
+CHANGE_GROUP_SIZE = 1000
+# Bump whenever build_rows (ROW_SOURCES, TRANSFORMERS) builds different
+# rows, this empties the cache
+ROWS_VERSION = 3
+CACHE_LOOKUP_SIZE = 1000
+# Rows per executemany in bulk_load
+BULK_CHUNK_SIZE = 1000
+# Connection settings for a full rebuild of a SQLite database: the journal
+# is kept in memory (a crash during the load can corrupt the database) and
+# nothing is synced until the end
+FAST_LOAD_PRAGMAS = (
+    ('journal_mode', 'MEMORY'),
+    ('synchronous', 'OFF'),
+    ('cache_size', -256 * 1024),
+    ('temp_store', 'MEMORY'),
+)
 
 
 def orm_name(name):
@@ -45,9 +68,56 @@ FIELD_CLASSES = (Component, Version, Milestone)
 
 TABLE_CLASS_MAP = dict((t.__table__.name, t) for t in MODEL_CLASSES)
 
+# Columns of Trac times, milliseconds since the epoch in the database and
+# ISO-8601 strings (or 0) in the file database
+TIME_COLUMNS = frozenset(['time', 'changetime', 'due', 'completed'])
+
+# How the files of each table are turned into rows, see
+# compile_transformer: the expression for the records of ``data`` (None
+# for one record per file) and the columns not simply looked up by name
+ROW_SOURCES = {
+    'component': (None, {}),
+    'version': (None, {}),
+    'milestone': (None, {}),
+    'enum': (None, {
+        'type': 'path_enum_type(fn)',
+        'name': 'key',
+        'value': 'record',
+    }),
+    'report': (None, {
+        'id': 'key',
+        'query': "record['sql']",
+        'author': "''",
+        'description': "''",
+    }),
+    # [id, created, changed, props]
+    'ticket': (None, {
+        None: 'record[3]',
+        'id': 'record[0]',
+        'time': 'record[1]',
+        'changetime': 'record[2]',
+    }),
+    # [[time, author, field, oldvalue, newvalue, permanent], ...]
+    'ticket_change': ('data', {
+        'ticket': 'key',
+        'time': 'record[0]',
+        'author': 'record[1]',
+        'field': 'record[2]',
+        'oldvalue': 'record[3]',
+        'newvalue': 'record[4]',
+    }),
+}
+# YYYY-MM-DD => milliseconds since the epoch, for iso8601_to_trac_time
+DAY_MS = {}
+
+
+class RebuildError(Exception):
+    pass
+
+
 def get_engine_url(filedb=None):
     if filedb is None:
-        filedb = dumptrac.DB()
+        filedb = dumptrac.open_db()
         filedb.init()
     return 'sqlite:///{}'.format(filedb.path_join('offtrac.db'))
 
@@ -56,6 +126,51 @@ def get_engine(filedb):
     return create_engine(get_engine_url(filedb))
 
 
+def sqlite_path(engine):
+    """The file of a SQLite ``engine``, None for other or memory databases"""
+    if engine.dialect.name != 'sqlite':
+        return None
+    path = engine.url.database
+    if not path or path == ':memory:':
+        return None
+    return os.path.abspath(path)
+
+
+def copy_sqlite_schema(src, dst, skip_data=()):
+    """Create the tables, indexes, views and triggers of the SQLite
+    connection ``src`` in ``dst``, and copy the rows of every table except
+    those named in ``skip_data`` (e.g. ``migrate_version`` is copied).
+
+    """
+    rows = src.execute(
+        "SELECT type, name, sql FROM sqlite_master "
+        "WHERE sql IS NOT NULL AND name NOT LIKE 'sqlite_%'").fetchall()
+    order = {'table': 0, 'index': 1, 'view': 2, 'trigger': 3}
+    rows.sort(key=lambda row: order.get(row[0], 4))
+    for kind, _name, sql in rows:
+        dst.execute(sql)
+    for kind, name, _sql in rows:
+        if kind != 'table' or name in skip_data:
+            continue
+        data = src.execute('SELECT * FROM "{}"'.format(name)).fetchall()
+        if data:
+            dst.execute('INSERT INTO "{}" VALUES ({})'.format(
+                name, ', '.join('?' * len(data[0]))), map(tuple, data))
+
+
+def fsync_path(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def open_row_cache(filedb, max_bytes=DEFAULT_MAX_BYTES):
+    return RowCache(filedb.path_join('offtrac-cache.db'), ROWS_VERSION,
+                    max_bytes)
+
+
 def get_session_class(engine):
     Session = sessionmaker(autocommit=True)
     Session.configure(bind=engine)
@@ -63,12 +178,33 @@ def get_session_class(engine):
 
 
 def iso8601_to_trac_time(isodatetime):
+    """Milliseconds since the epoch of a UTC ``YYYY-MM-DDTHH:MM:SS``. The
+    date is parsed once and memoized in ``DAY_MS``, the time of day is
+    sliced out of the string, anything else goes through ``time.strptime``.
+
+    """
     if not isodatetime:
         return isodatetime
+    s = isodatetime
+    if (len(s) == 19 and s[10] == 'T' and s[13] == ':' and s[16] == ':' and
+            s[11:13].isdigit() and s[14:16].isdigit() and s[17:19].isdigit()):
+        day = DAY_MS.get(s[:10])
+        if day is None:
+            day = DAY_MS[s[:10]] = int(calendar.timegm(
+                time.strptime(s[:10], '%Y-%m-%d')) * 1000)
+        hours, minutes, seconds = int(s[11:13]), int(s[14:16]), int(s[17:19])
+        # The ranges strptime accepts
+        if hours < 24 and minutes < 60 and seconds < 62:
+            return day + ((hours * 60 + minutes) * 60 + seconds) * 1000
     utc_tuple = time.strptime(isodatetime, '%Y-%m-%dT%H:%M:%S')
     return int(calendar.timegm(utc_tuple) * 1000)
 
 
+def path_enum_type(path):
+    """The enum type of ``field/<type>/<name>.json``"""
+    return os.path.basename(os.path.dirname(path))
+
+
 def new_bigtime(isodatetime, old_bigtime=None):
     bigtime = iso8601_to_trac_time(isodatetime)
     if old_bigtime is None or bigtime > old_bigtime:
@@ -76,12 +212,106 @@ def new_bigtime(isodatetime, old_bigtime=None):
     return old_bigtime + 1
 
 
+def compile_transformer(table, records, columns):
+    """Compile the function turning ``(fn, data)``, a JSON file of the
+    file database and its contents, into the column dicts of the rows of
+    ``table``. ``records`` is an expression for the records of ``data``,
+    one row each, or None when ``data`` is the only one. ``columns`` maps
+    column names to expressions over ``record``, ``fn`` and ``key`` (the
+    id in the file name). Other columns are looked up by name in the
+    mapping at ``columns[None]`` (default ``record``). Columns in
+    ``TIME_COLUMNS`` are converted with ``iso8601_to_trac_time``, or
+    ``new_bigtime`` when they are part of the primary key.
+
+    """
+    by_name = columns.get(None, 'record')
+    setup = []
+    items = []
+    for column in table.columns:
+        expr = columns.get(column.key)
+        if expr is None:
+            expr = '{}.get({!r})'.format(by_name, str(column.key))
+        if column.key in TIME_COLUMNS:
+            if column.primary_key:
+                setup.append('bigtime = new_bigtime({}, bigtime)'.format(expr))
+                expr = 'bigtime'
+            else:
+                expr = 'iso8601_to_trac_time({})'.format(expr)
+        items.append('{!r}: {}'.format(str(column.key), expr))
+    name = 'transform_' + table.name
+    prologue = []
+    if any(re.search(r'\bkey\b', expr) for expr in columns.itervalues()):
+        prologue.append('key = path_id(fn)')
+    if setup:
+        prologue.append('bigtime = None')
+    row = '{{{}}}'.format(', '.join(items))
+    if records is None:
+        body = ['record = data'] + setup + ['return [{}]'.format(row)]
+    else:
+        body = ['rows = []', 'for record in {}:'.format(records)] + [
+            '    ' + line for line in setup + ['rows.append({})'.format(row)]
+        ] + ['return rows']
+    source = '\n'.join(['def {}(fn, data):'.format(name)] +
+                       ['    ' + line for line in prologue + body])
+    namespace = dict(
+        path_id=path_id,
+        path_enum_type=path_enum_type,
+        iso8601_to_trac_time=iso8601_to_trac_time,
+        new_bigtime=new_bigtime)
+    exec compile(source, '<{}>'.format(name), 'exec') in namespace
+    return namespace[name]
+
+
+TRANSFORMERS = dict(
+    (name, compile_transformer(getattr(model, name), records, columns))
+    for name, (records, columns) in ROW_SOURCES.iteritems())
+
+
+def build_rows(table_name, fn, data):
+    """The column dicts of the rows of table ``table_name`` stored in
+    ``fn``. This is the transform the ETL worker processes run.
+
+    """
+    return TRANSFORMERS[table_name](fn, data)
+
+
+def rows_transform(cls):
+    """A picklable ``transform`` for ``DB.iter_jsondir`` that builds the
+    rows of ``cls``
+
+    """
+    return functools.partial(build_rows, cls.__table__.name)
+
+
 class ETL(object):
     ENUM_TYPES = ('priority', 'resolution', 'severity', 'type')
 
-    def __init__(self, filedb, Session):
+    def __init__(self, filedb, Session, jobs=None, cache=None, bulk=True,
+                 fast_load=True, shadow=True):
         self.filedb = filedb
         self.Session = Session
+        # Reindex with executemany and set-based statements instead of
+        # the ORM
+        self.bulk = bulk
+        # bulk_load on SQLite with FAST_LOAD_PRAGMAS and the indexes
+        # dropped until the data is in
+        self.fast_load = fast_load
+        # Full rebuilds of a SQLite file go to a new file that replaces the
+        # live one when complete
+        self.shadow = shadow
+        # (table name, rows, seconds) of the last bulk_load
+        self.load_stats = []
+        # (phase, seconds) of the last bulk_load
+        self.phase_stats = []
+        # Statements executed by insert_rows and delete_rows
+        self.statements = 0
+        # Rows inserted by insert_rows
+        self.rows_written = 0
+        # Worker processes converting JSON files to rows
+        self.jobs = jobs
+        # A RowCache or None
+        self.cache = cache
+        self._blob_ids = None
 
     def reindex(self):
         session = self.Session()
@@ -95,39 +325,108 @@ class ETL(object):
         else:
             self.full_reindex()
 
-    def incremental_reindex(self, git_head):
-        changes = list(self.filedb.changed_files(git_head))
-        print 'Starting incremental_reindex from {} to {} with {} changes'.format(
-            git_head[:7], self.filedb.git_head[:7], len(changes))
-        if not changes:
-            return
+    def incremental_reindex(self, git_head, group_size=CHANGE_GROUP_SIZE):
+        print 'Starting incremental_reindex from {} to {}'.format(
+            git_head[:7], self.filedb.git_head[:7])
+        count = 0
+        self.statements = 0
+        self.rows_written = 0
         session = self.Session()
         with session.begin():
-            for modes, fn in changes:
-                cls = self.lookup_class(fn)
-                if cls is None:
-                    continue
-                if 'D' in modes:
-                    if cls is Enum:
-                        typ = path_id(os.path.dirname(fn))
-                        name = path_id(fn)
-                        session.query(Enum).filter(and_(
-                            Enum.type == path_id(os.path.dirname(fn)),
-                            Enum.name == path_id(fn))).delete()
-                    else:
-                        pk = list(cls.__table__.primary_key.columns)[0]
-                        session.query(cls).filter(pk == path_id(fn)).delete()
-                else:
-                    lst = self.from_disk(cls, fn)
-                    if 'A' in modes:
-                        session.add_all(lst)
-                    else:
-                        for obj in lst:
-                            session.merge(obj)
-            session.query(OfftracMeta).delete()
-            session.add_all(self.ormify_offtrac_meta())
+            changes = expand_renames(self.filedb.iter_changes(git_head))
+            if self.cache is not None:
+                changes = self.record_blob_ids(changes)
+            if self.bulk:
+                conn = session.connection()
+                for group in chunked(changes, group_size):
+                    self.apply_changes(conn, group)
+                    count += len(group)
+                if count:
+                    conn.execute(model.offtrac_meta.delete())
+                    self.insert_rows(conn, model.offtrac_meta,
+                                     self.offtrac_meta_rows())
+            else:
+                for group in chunked(changes, group_size):
+                    for change in group:
+                        self.apply_change(session, change.status, change.path)
+                    count += len(group)
+                    # Keep the identity map bounded on large catch-ups
+                    session.flush()
+                    session.expunge_all()
+                if count:
+                    session.query(OfftracMeta).delete()
+                    session.add_all(self.ormify_offtrac_meta())
+        if self.bulk:
+            print 'Applied {} changes with {} statements'.format(
+                count, self.statements)
+        else:
+            print 'Applied {} changes'.format(count)
+        self.flush_cache()
+
+    def apply_changes(self, conn, changes):
+        """Apply a group of ``Change`` records with set-based statements:
+        the deleted rows of each table go in one DELETE, the changelog of
+        each changed ticket is deleted and inserted again, and the other
+        rows are written with one batched INSERT OR REPLACE per table.
+        The files are converted to rows by the worker processes.
+
+        """
+        deletes = defaultdict(list)
+        upserts = defaultdict(list)
+        blobs = self.head_blob_ids() if self.cache is not None else {}
+        for change in changes:
+            cls = self.lookup_class(change.path)
+            if cls is None:
+                continue
+            table = cls.__table__
+            if cls is Enum:
+                key = (path_enum_type(change.path),
+                       path_id(change.path))
+            else:
+                key = (path_id(change.path),)
+            if 'D' in change.status or cls is TicketChange:
+                deletes[table].append(key)
+            if 'D' not in change.status:
+                upserts[cls].append(change.path)
+        for table, keys in deletes.iteritems():
+            self.delete_rows(conn, table, keys)
+        for cls, relpaths in upserts.iteritems():
+            table = cls.__table__
+            rows = itertools.chain.from_iterable(
+                self.files_rows(cls, relpaths, blobs))
+            prefix = None if table is model.ticket_change else 'OR REPLACE'
+            self.insert_rows(conn, table, rows, prefix=prefix)
+
+    def apply_change(self, session, modes, fn):
+        cls = self.lookup_class(fn)
+        if cls is None:
+            return
+        if 'D' in modes:
+            if cls is Enum:
+                session.query(Enum).filter(and_(
+                    Enum.type == path_enum_type(fn),
+                    Enum.name == path_id(fn))).delete()
+            else:
+                pk = list(cls.__table__.primary_key.columns)[0]
+                session.query(cls).filter(pk == path_id(fn)).delete()
+        else:
+            lst = self.from_disk(cls, fn)
+            if 'A' in modes:
+                session.add_all(lst)
+            else:
+                for obj in lst:
+                    session.merge(obj)
 
     def full_reindex(self):
+        if self.bulk:
+            if self.shadow and sqlite_path(self.Session().bind):
+                self.shadow_rebuild()
+            else:
+                self.bulk_load()
+            print 'phases: {}'.format(', '.join(
+                '{} {:.2f}s'.format(name, seconds)
+                for name, seconds in self.phase_stats))
+            return
         print 'Starting full_reindex()'
         session = self.Session()
         with session.begin():
@@ -139,12 +438,259 @@ class ETL(object):
             session.add_all(self.ormify_report())
             session.add_all(self.ormify_changelog())
             session.add_all(self.ormify_offtrac_meta())
+        self.flush_cache()
+
+    def bulk_load(self):
+        """``full_reindex`` that inserts plain row tuples with chunked
+        ``executemany`` instead of going through the session, so memory
+        stays bounded by ``BULK_CHUNK_SIZE`` rows.
+
+        With ``fast_load`` on SQLite the connection uses
+        ``FAST_LOAD_PRAGMAS``, the indexes from ``offtrac.model`` are
+        dropped before the load and created again after it, followed by
+        ``ANALYZE``.
+
+        """
+        print 'Starting full_reindex() (bulk)'
+        self.load_stats = []
+        self.phase_stats = []
+        self.rows_written = 0
+        conn = self.Session().bind.connect()
+        saved = None
+        indexes = []
+        try:
+            fast = self.fast_load and conn.dialect.name == 'sqlite'
+            t0 = time.time()
+            if fast:
+                saved = self.set_pragmas(conn, FAST_LOAD_PRAGMAS)
+                # DDL first: pysqlite commits any open transaction before it
+                indexes = self.drop_indexes(conn)
+                t0 = self.phase('drop indexes', t0)
+            with conn.begin():
+                for Class in MODEL_CLASSES:
+                    conn.execute(Class.__table__.delete())
+                t0 = self.phase('delete', t0)
+                for table, rows in self.table_rows():
+                    t1 = time.time()
+                    count = self.insert_rows(conn, table, rows)
+                    elapsed = time.time() - t1
+                    self.load_stats.append((table.name, count, elapsed))
+                    print '{}: {} rows in {:.2f}s ({:.0f} rows/s)'.format(
+                        table.name, count, elapsed,
+                        count / max(elapsed, 1e-6))
+            t0 = self.phase('load', t0)
+            if fast:
+                self.create_indexes(conn, indexes)
+                indexes = []
+                t0 = self.phase('create indexes', t0)
+                conn.execute('ANALYZE')
+                t0 = self.phase('analyze', t0)
+        except Exception:
+            exc_info = sys.exc_info()
+            if indexes:
+                # The load was rolled back, don't leave the tables without
+                # their indexes
+                self.create_indexes(conn, indexes)
+            raise exc_info[0], exc_info[1], exc_info[2]
+        finally:
+            try:
+                if saved is not None:
+                    self.set_pragmas(conn, saved)
+            finally:
+                conn.close()
+        self.flush_cache()
+
+    def shadow_rebuild(self):
+        """``bulk_load`` into a new database file beside the live one (with
+        the same schema and the rows of the tables that are not
+        reindexed), verify it, and rename it over the live file. Readers
+        of the live database keep their snapshot, they are never blocked
+        by the load.
+
+        """
+        live_engine = self.Session().bind
+        live = sqlite_path(live_engine)
+        # Still matched by the *.db ignore, a killed rebuild is never
+        # committed to the file database
+        root, ext = os.path.splitext(live)
+        shadow = root + '.rebuild' + ext
+        for fn in (shadow, shadow + '-journal'):
+            if os.path.exists(fn):
+                os.remove(fn)
+        print 'Rebuilding into', shadow
+        shadow_engine = create_engine('sqlite:///' + shadow)
+        Session = self.Session
+        try:
+            t0 = time.time()
+            src = live_engine.connect()
+            dst = shadow_engine.connect()
+            try:
+                copy_sqlite_schema(
+                    src, dst, skip_data=[cls.__table__.name
+                                         for cls in MODEL_CLASSES])
+            finally:
+                dst.close()
+                src.close()
+            model.metadata.create_all(
+                shadow_engine,
+                tables=[cls.__table__ for cls in MODEL_CLASSES])
+            schema_seconds = time.time() - t0
+            self.Session = get_session_class(shadow_engine)
+            self.bulk_load()
+            self.phase_stats.insert(0, ('copy schema', schema_seconds))
+            t0 = time.time()
+            self.verify(shadow_engine)
+            t0 = self.phase('verify', t0)
+            shadow_engine.dispose()
+            # The load ran with synchronous=OFF
+            fsync_path(shadow)
+            os.rename(shadow, live)
+            fsync_path(os.path.dirname(live))
+            self.phase('swap', t0)
+        except:
+            shadow_engine.dispose()
+            if os.path.exists(shadow):
+                os.remove(shadow)
+            raise
+        finally:
+            self.Session = Session
+
+    def verify(self, engine):
+        """Check a freshly loaded database before it goes live"""
+        conn = engine.connect()
+        try:
+            result = conn.execute('PRAGMA integrity_check').scalar()
+            if result != 'ok':
+                raise RebuildError('integrity_check: {}'.format(result))
+            for name, count, _seconds in self.load_stats:
+                actual = conn.execute(
+                    'SELECT COUNT(*) FROM "{}"'.format(name)).scalar()
+                if actual != count:
+                    raise RebuildError('{} has {} rows, loaded {}'.format(
+                        name, actual, count))
+            git_head = conn.execute(
+                model.offtrac_meta.select().where(
+                    model.offtrac_meta.c.key == 'git_head')).fetchone()
+            if git_head is None or git_head['value'] != self.filedb.git_head:
+                raise RebuildError('git_head is not {}'.format(
+                    self.filedb.git_head))
+        finally:
+            conn.close()
+
+    def phase(self, name, t0):
+        """Record the time since ``t0`` for phase ``name``, returns now"""
+        now = time.time()
+        self.phase_stats.append((name, now - t0))
+        return now
+
+    def set_pragmas(self, conn, pragmas):
+        """Set SQLite ``pragmas`` on ``conn``, returns the previous values"""
+        saved = []
+        for name, value in pragmas:
+            saved.append(
+                (name, conn.execute('PRAGMA {}'.format(name)).scalar()))
+            conn.execute('PRAGMA {} = {}'.format(name, value))
+        return saved
+
+    def drop_indexes(self, conn):
+        """Drop the ``offtrac.model`` indexes of the tables a full reindex
+        fills, returns them so they can be created again
+
+        """
+        existing = set(name for name, in conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'index'"))
+        dropped = []
+        for Class in MODEL_CLASSES:
+            for index in sorted(Class.__table__.indexes,
+                                key=lambda index: index.name):
+                if index.name in existing:
+                    index.drop(bind=conn)
+                dropped.append(index)
+        return dropped
+
+    def create_indexes(self, conn, indexes):
+        """Create those of ``indexes`` that do not exist"""
+        existing = set(name for name, in conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'index'"))
+        for index in indexes:
+            if index.name not in existing:
+                index.create(bind=conn)
+
+    def insert_rows(self, conn, table, rows, chunk_size=BULK_CHUNK_SIZE,
+                    prefix=None):
+        """Insert the column dicts ``rows`` into ``table``, returns the
+        number of rows. Columns missing from a dict are NULL, keys that
+        are not columns are ignored. ``prefix`` goes after INSERT, e.g.
+        ``'OR REPLACE'``.
+
+        """
+        columns = [column.key for column in table.columns]
+        insert = table.insert()
+        if prefix:
+            insert = insert.prefix_with(prefix)
+        sql = unicode(insert.compile(dialect=conn.dialect,
+                                     column_keys=columns))
+        count = 0
+        tuples = ([row.get(column) for column in columns] for row in rows)
+        for chunk in chunked(itertools.imap(tuple, tuples), chunk_size):
+            conn.execute(sql, chunk)
+            self.statements += 1
+            count += len(chunk)
+        self.rows_written += count
+        return count
+
+    def delete_rows(self, conn, table, keys, chunk_size=BULK_CHUNK_SIZE):
+        """Delete the rows of ``table`` matching ``keys``, tuples of values
+        for the leading primary key columns
+
+        """
+        if not keys:
+            return
+        columns = list(table.primary_key.columns)[:len(keys[0])]
+        if len(columns) == 1:
+            column = columns[0]
+            # Below SQLite's limit of 999 host parameters
+            for chunk in chunked(sorted(set(keys)), 500):
+                conn.execute(table.delete().where(
+                    column.in_([key for key, in chunk])))
+                self.statements += 1
+        else:
+            delete = table.delete().where(and_(
+                *[column == bindparam('k_' + column.key)
+                  for column in columns]))
+            conn.execute(delete, [
+                dict(('k_' + column.key, value)
+                     for column, value in zip(columns, key))
+                for key in keys])
+            self.statements += 1
+
+    def table_rows(self):
+        """``(table, rows)`` for each table a full reindex fills, ``rows``
+        an iterable of column dicts
+
+        """
+        for FieldClass in FIELD_CLASSES:
+            table = FieldClass.__table__
+            yield table, self.dir_rows(FieldClass, 'field/' + table.name)
+        yield model.enum, itertools.chain.from_iterable(
+            self.dir_rows(Enum, 'field/' + enum_type)
+            for enum_type in self.ENUM_TYPES)
+        yield model.ticket, self.dir_rows(Ticket, 'ticket')
+        yield model.report, self.dir_rows(Report, 'report')
+        yield model.ticket_change, self.dir_rows(TicketChange, 'changelog')
+        yield model.offtrac_meta, self.offtrac_meta_rows()
+
+    def flush_cache(self):
+        if self.cache is not None:
+            self.cache.flush()
+            print self.cache.report()
 
     def lookup_class(self, fn):
         parts = fn.split('/')
-        if not (1 < len(parts) < 3):
-            return None
         first = parts[0]
+        # field/<type>/<name>.json, otherwise <table>/<id>.json
+        if len(parts) != (3 if first == 'field' else 2):
+            return None
         if first == 'field':
             if parts[1] in self.ENUM_TYPES:
                 return Enum
@@ -153,98 +699,179 @@ class ETL(object):
             return TicketChange
         return TABLE_CLASS_MAP.get(first)
 
+    def record_blob_ids(self, changes):
+        """Yield ``changes``, keeping the blob id of each changed file for
+        ``blob_id`` so an incremental reindex does not list all of HEAD.
+        Files that differ from HEAD in the working tree are left out.
+
+        """
+        self._blob_ids = {}
+        dirty = set()
+        if not self.filedb.is_clean():
+            dirty = set(self.filedb.dirty_files())
+        for change in changes:
+            if change.blob is not None and change.path not in dirty:
+                self._blob_ids[change.path] = change.blob
+            yield change
+
+    def head_blob_ids(self):
+        """The blob ids of every JSON file at HEAD, loaded once"""
+        if self._blob_ids is None:
+            self._blob_ids = self.filedb.blob_ids()
+        return self._blob_ids
+
+    def blob_id(self, fn):
+        """The git blob id of ``fn`` (relative to the file database) at
+        HEAD, or None
+
+        """
+        return self.head_blob_ids().get(fn)
+
     def from_disk(self, cls, fn):
-        data = self.filedb.load_json(fn)
-        if cls is Enum:
-            data = dict(
-                type=path_id(os.path.dirname(fn)),
-                name=path_id(fn),
-                value=data)
-        elif cls is Milestone:
-            data = dict(
-                data,
-                due=iso8601_to_trac_time(data['due']),
-                completed=iso8601_to_trac_time(data['completed']))
-        elif cls is Ticket:
-            ticket_id, created, changed, props = data
-            data = dict(props,
-                id=ticket_id,
-                time=iso8601_to_trac_time(created),
-                changetime=iso8601_to_trac_time(changed))
-        elif cls is TicketChange:
-            return self._ticket_changes(path_id(fn), data)
-        elif cls is Report:
-            data = dict(
-                id=path_id(fn),
-                title=data['title'],
-                query=data['sql'],
-                author='',
-                description='')
-        return [cls(**data)]
-
-    def _ticket_changes(self, ticket_id, data):
-        bigtime = None
-        for isotime, author, field, oldvalue, newvalue, _permanent in data:
-            bigtime = new_bigtime(isotime, bigtime)
-            yield TicketChange(
-                ticket=ticket_id,
-                time=bigtime,
-                author=author,
-                field=field,
-                oldvalue=oldvalue,
-                newvalue=newvalue)
+        return [cls(**row) for row in self.file_rows(cls, fn)]
+
+    def file_rows(self, cls, fn):
+        """The row dicts of ``cls`` in ``fn``, from the cache if possible"""
+        blob = self.blob_id(fn) if self.cache is not None else None
+        rows = None
+        if blob is not None:
+            rows = self.cache.get((fn, blob))
+        if rows is None:
+            rows = self.to_rows(cls, fn, self.filedb.load_json(fn))
+            if blob is not None:
+                self.cache.put((fn, blob), rows)
+        return rows
+
+    def to_rows(self, cls, fn, data):
+        """The column dicts of the rows of ``cls`` stored in ``fn``"""
+        return build_rows(cls.__table__.name, fn, data)
+
+    def iter_rows(self, cls, dirname):
+        """Yield the list of row dicts of ``cls`` for each JSON file in
+        ``dirname``, in file name order. The files are parsed and
+        converted on ``self.jobs`` worker processes while this process
+        writes, rows of files unchanged since they were cached are not
+        parsed again.
+
+        """
+        blobs = {}
+        if self.cache is not None:
+            blobs = self.filedb.blob_ids(dirname)
+        if not blobs:
+            for _fn, rows in self.filedb.iter_jsondir(
+                    dirname, self.jobs, rows_transform(cls)):
+                yield rows
+            return
+        relpaths = [self.filedb.relpath(fn)
+                    for fn in sorted(self.filedb.json_glob(dirname))]
+        for rows in self.files_rows(cls, relpaths, blobs):
+            yield rows
+
+    def files_rows(self, cls, relpaths, blobs):
+        """Yield the list of row dicts of ``cls`` for each of ``relpaths``
+        in order. Files with a cached blob id in ``blobs`` are not parsed,
+        the others are converted on ``self.jobs`` worker processes.
+
+        """
+        keys = [(relpath, blobs.get(relpath)) for relpath in relpaths]
+        cached = set()
+        if self.cache is not None:
+            cached = self.cache.contains([key for key in keys if key[1]])
+        converted = self.filedb.iter_json_files(
+            [self.filedb.path_join(key[0]) for key in keys
+             if key not in cached],
+            self.jobs, rows_transform(cls))
+        for group in chunked(keys, CACHE_LOOKUP_SIZE):
+            hits = {}
+            if cached:
+                hits = self.cache.get_many(
+                    [key for key in group if key in cached])
+            for key in group:
+                rows = hits.get(key)
+                if rows is None:
+                    _fn, rows = next(converted)
+                    if key[1] is not None and self.cache is not None:
+                        self.cache.put(key, rows)
+                yield rows
+
+    def offtrac_meta_rows(self):
+        yield dict(key='git_head', value=self.filedb.git_head)
+        for k, v in self.filedb.metadata.iteritems():
+            yield dict(key=k, value=v)
+
+    def dir_rows(self, cls, dirname):
+        for rows in self.iter_rows(cls, dirname):
+            for row in rows:
+                yield row
 
     def ormify_offtrac_meta(self):
-        yield OfftracMeta(key='git_head', value=self.filedb.git_head)
-        for k, v in self.filedb.metadata.iteritems():
-            yield OfftracMeta(key=k, value=v)
+        for row in self.offtrac_meta_rows():
+            yield OfftracMeta(**row)
+
+    def ormify_dir(self, cls, dirname):
+        for row in self.dir_rows(cls, dirname):
+            yield cls(**row)
 
     def ormify_enum(self):
         for enum_type in self.ENUM_TYPES:
-            for fn, data in self.filedb.iter_jsondir('field/' + enum_type):
-                yield Enum(type=enum_type, name=path_id(fn), value=data)
+            for obj in self.ormify_dir(Enum, 'field/' + enum_type):
+                yield obj
 
     def ormify_fields(self):
         for FieldClass in FIELD_CLASSES:
             table = FieldClass.__table__
-            for _fn, data in self.filedb.iter_jsondir('field/' + table.name):
-                if FieldClass is Milestone:
-                    data = dict(
-                        data,
-                        due=iso8601_to_trac_time(data['due']),
-                        completed=iso8601_to_trac_time(data['completed']))
-                yield FieldClass(**data)
+            for obj in self.ormify_dir(FieldClass, 'field/' + table.name):
+                yield obj
 
     def ormify_ticket(self):
-        for _fn, data in self.filedb.iter_jsondir('ticket'):
-            ticket_id, created, changed, props = data
-            props = dict(props,
-                id=ticket_id,
-                time=iso8601_to_trac_time(created),
-                changetime=iso8601_to_trac_time(changed))
-            yield Ticket(**props)
+        return self.ormify_dir(Ticket, 'ticket')
 
     def ormify_changelog(self):
-        for fn, data in self.filedb.iter_jsondir('changelog'):
-            for obj in self._ticket_changes(path_id(fn), data):
-                yield obj
+        return self.ormify_dir(TicketChange, 'changelog')
 
     def ormify_report(self):
-        for fn, props in self.filedb.iter_jsondir('report'):
-            yield Report(
-                id=path_id(fn),
-                title=props['title'],
-                query=props['sql'],
-                author='',
-                description='')
-
-def main():
-    filedb = dumptrac.DB()
+        return self.ormify_dir(Report, 'report')
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('-j', '--jobs', type='int',
+                      default=dumptrac.default_jobs(),
+                      help='worker processes converting JSON files to rows, '
+                           'the database is written by this process only '
+                           '(default: %default)')
+    parser.add_option('--cache-size', type='int',
+                      default=DEFAULT_MAX_BYTES / (1024 * 1024),
+                      help='MiB of converted rows to keep in '
+                           'db/offtrac-cache.db (default: %default)')
+    parser.add_option('--orm', action='store_true', default=False,
+                      help='write rows through the ORM session instead of '
+                           'bulk statements, in both the full and the '
+                           'incremental reindex')
+    parser.add_option('--no-cache', action='store_true', default=False,
+                      help='parse every file, without the row cache')
+    parser.add_option('--no-fast-load', action='store_true', default=False,
+                      help='keep the indexes and the default SQLite '
+                           'settings during a full reindex')
+    parser.add_option('--in-place', action='store_true', default=False,
+                      help='do a full reindex in the live database instead '
+                           'of a new file that replaces it')
+    (options, _args) = parser.parse_args(argv)
+    filedb = dumptrac.open_db()
     filedb.init()
     engine = get_engine(filedb)
     # model.metadata.create_all(engine)
-    imp = ETL(filedb, get_session_class(engine=engine))
-    imp.reindex()
+    cache = None
+    if not options.no_cache:
+        cache = open_row_cache(filedb, options.cache_size * 1024 * 1024)
+    try:
+        imp = ETL(filedb, get_session_class(engine=engine), jobs=options.jobs,
+                  cache=cache, bulk=not options.orm,
+                  fast_load=not options.no_fast_load,
+                  shadow=not options.in_place)
+        imp.reindex()
+    finally:
+        if cache is not None:
+            cache.close()
 
 
 if __name__ == '__main__':
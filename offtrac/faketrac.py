@@ -0,0 +1,389 @@
+#!/usr/bin/env python
+"""
+Local stand-in for a Trac instance with the XmlRpcPlugin, serving synthetic
+data over the subset of ``/login/jsonrpc`` and ``/report`` that
+``offtrac.dumptrac`` uses. Useful for benchmarks and for trying out the
+sync without touching a real Trac.
+
+Runs with ``python -mofftrac.faketrac --tickets 10000 --port 8000``.
+
+Besides the Trac URLs it serves ``GET /_stats`` (request and byte counts)
+and ``POST /_touch?count=N`` (change N tickets and create N new ones) so
+that it can be driven from another process.
+
+"""
+from __future__ import with_statement
+
+import gzip
+import time
+import random
+import calendar
+import optparse
+import threading
+import SocketServer
+import BaseHTTPServer
+from cStringIO import StringIO
+
+import simplejson as json
+
+from .dumptrac import jsondatetime, jsonclass_hook
+
+EPOCH = calendar.timegm((2010, 1, 1, 0, 0, 0))
+USEC = 1000000
+ENUMS = {
+    'priority': ('Highest', 'High', 'Medium', 'Low', 'Lowest'),
+    'resolution': ('fixed', 'invalid', 'wontfix', 'duplicate', 'worksforme'),
+    'severity': ('blocker', 'critical', 'major', 'normal', 'minor'),
+    'type': ('defect', 'enhancement', 'task'),
+}
+STATUSES = ('new', 'assigned', 'accepted', 'reopened', 'closed')
+USERS = ('alice', 'bob', 'carol', 'dave', 'erin', 'frank')
+WORDS = ('the', 'banner', 'click', 'swf', 'report', 'should', 'crash',
+         'when', 'loading', 'game', 'ads', 'server', 'timeout', 'user',
+         'page', 'fix', 'deploy', 'missing', 'slow', 'query', 'flash')
+
+
+def isotime(t):
+    return time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(t))
+
+
+def usec_isotime(t):
+    """``isotime`` of ``t`` microseconds, the fraction is dropped like
+    the plugin's datetimes do
+
+    """
+    return isotime(t // USEC)
+
+
+def parse_usec(s):
+    return calendar.timegm(time.strptime(s, '%Y-%m-%dT%H:%M:%S')) * USEC
+
+
+class FakeTracData(object):
+    """Deterministic synthetic Trac contents.
+
+    Times are kept as integer microseconds like Trac 0.12 and serialized as
+    ``__jsonclass__`` datetimes to the second like the real plugin does, so
+    ``ticket.changeLog(id, when)`` rarely finds the entries at ``when``.
+    With ``whole_seconds`` every time is a whole second and it always
+    does. ``touch`` simulates new activity for an incremental sync.
+
+    """
+    def __init__(self, tickets=1000, changes=5, components=20,
+                 milestones=10, versions=10, reports=20, seed=0,
+                 whole_seconds=False):
+        self.rand = random.Random(seed)
+        self.lock = threading.Lock()
+        self.whole_seconds = whole_seconds
+        self.now = EPOCH * USEC
+        self.components = ['component-%d' % (i,) for i in xrange(components)]
+        self.milestones = ['milestone %d' % (i,) for i in xrange(milestones)]
+        self.versions = ['1.%d' % (i,) for i in xrange(versions)]
+        self.reports = [(i, 'Report %d' % (i,))
+                        for i in xrange(1, reports + 1)]
+        self.tickets = {}
+        self.changelogs = {}
+        for ticket_id in xrange(1, tickets + 1):
+            self.new_ticket(ticket_id)
+            for _i in xrange(changes):
+                self.change_ticket(ticket_id)
+
+    def text(self, words):
+        return ' '.join(self.rand.choice(WORDS) for _i in xrange(words))
+
+    def tick(self):
+        if self.whole_seconds:
+            self.now += self.rand.randint(1, 600) * USEC
+        else:
+            self.now += self.rand.randint(1, 600 * USEC)
+        return self.now
+
+    def new_ticket(self, ticket_id):
+        now = self.tick()
+        props = {
+            'cc': '',
+            'component': self.rand.choice(self.components),
+            'description': self.text(self.rand.randint(10, 200)),
+            'keywords': '',
+            'milestone': self.rand.choice(self.milestones),
+            'owner': self.rand.choice(USERS),
+            'priority': self.rand.choice(ENUMS['priority']),
+            'reporter': self.rand.choice(USERS),
+            'resolution': '',
+            'severity': self.rand.choice(ENUMS['severity']),
+            'status': 'new',
+            'summary': self.text(8),
+            'type': self.rand.choice(ENUMS['type']),
+            'version': self.rand.choice(self.versions),
+        }
+        self.tickets[ticket_id] = [ticket_id, now, now, props]
+        self.changelogs[ticket_id] = []
+
+    def change_ticket(self, ticket_id):
+        """Add a change group: a comment plus one field change, like an edit
+        made through the web UI.
+
+        """
+        now = self.tick()
+        ticket = self.tickets[ticket_id]
+        props = ticket[3]
+        changelog = self.changelogs[ticket_id]
+        author = self.rand.choice(USERS)
+        cnum = 1 + sum(1 for change in changelog if change[2] == 'comment')
+        field = self.rand.choice(('status', 'owner', 'priority', 'milestone'))
+        if field == 'status':
+            new = self.rand.choice(STATUSES)
+        elif field == 'owner':
+            new = self.rand.choice(USERS)
+        elif field == 'priority':
+            new = self.rand.choice(ENUMS['priority'])
+        else:
+            new = self.rand.choice(self.milestones)
+        changelog.append([now, author, 'comment', str(cnum),
+                          self.text(self.rand.randint(0, 60)), 1])
+        if props[field] != new:
+            changelog.append([now, author, field, props[field], new, 1])
+            props[field] = new
+        ticket[2] = now
+
+    def touch(self, count):
+        """Change ``count`` random existing tickets and create as many new
+        ones, returns the changed ids.
+
+        """
+        with self.lock:
+            ids = self.rand.sample(sorted(self.tickets),
+                                   min(count, len(self.tickets)))
+            for ticket_id in ids:
+                self.change_ticket(ticket_id)
+            for _i in xrange(count):
+                ticket_id = 1 + max(self.tickets)
+                self.new_ticket(ticket_id)
+                ids.append(ticket_id)
+            return ids
+
+    def ticket_get(self, ticket_id):
+        ticket_id, created, changed, props = self.tickets[ticket_id]
+        props = dict(props,
+                     time=jsondatetime(usec_isotime(created)),
+                     changetime=jsondatetime(usec_isotime(changed)))
+        return [ticket_id, jsondatetime(usec_isotime(created)),
+                jsondatetime(usec_isotime(changed)), props]
+
+    def ticket_changelog(self, ticket_id, when=0):
+        changes = self.changelogs[ticket_id]
+        if when:
+            # Trac 0.12 compares microsecond timestamps for equality
+            when = parse_usec(when)
+            changes = [c for c in changes if c[0] == when]
+        return [[jsondatetime(usec_isotime(c[0]))] + c[1:] for c in changes]
+
+    def recent_changes(self, since):
+        since = parse_usec(since)
+        return sorted(ticket_id
+                      for ticket_id, ticket in self.tickets.iteritems()
+                      if ticket[2] >= since)
+
+    def field_get_all(self, field):
+        if field == 'component':
+            return self.components
+        elif field == 'milestone':
+            return self.milestones
+        elif field == 'version':
+            return self.versions
+        return list(ENUMS[field])
+
+    def field_get(self, field, name):
+        if field == 'component':
+            return {'name': name, 'owner': USERS[hash(name) % len(USERS)],
+                    'description': 'All about ' + name}
+        elif field == 'milestone':
+            return {'name': name, 'due': 0, 'completed': 0,
+                    'description': 'Work planned for ' + name}
+        elif field == 'version':
+            return {'name': name, 'time': 0, 'description': ''}
+        return str(1 + list(ENUMS[field]).index(name))
+
+    def dispatch(self, method, params):
+        with self.lock:
+            if method == 'ticket.get':
+                return self.ticket_get(*params)
+            elif method == 'ticket.changeLog':
+                return self.ticket_changelog(*params)
+            elif method == 'ticket.getRecentChanges':
+                return self.recent_changes(*params)
+            parts = method.split('.')
+            if len(parts) == 3 and parts[0] == 'ticket':
+                if parts[2] == 'getAll':
+                    return self.field_get_all(parts[1])
+                elif parts[2] == 'get':
+                    return self.field_get(parts[1], *params)
+        raise KeyError(method)
+
+    def report_tab(self):
+        lines = ['report\ttitle']
+        lines.extend('%d\t%s' % report for report in self.reports)
+        return '\n'.join(lines) + '\n'
+
+    def report_sql(self, report_id):
+        return ('-- ## %d: %s ## --\n\nSELECT id AS ticket, summary '
+                'FROM ticket WHERE status <> \'closed\'\n' % (
+                    report_id, dict(self.reports)[report_id]))
+
+
+class FakeTracHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(
+                self, format, *args)
+
+    def send_body(self, status, body, content_type='text/plain'):
+        if 'gzip' in self.headers.get('accept-encoding', ''):
+            sio = StringIO()
+            with gzip.GzipFile(fileobj=sio, mode='wb') as f:
+                f.write(body)
+            body = sio.getvalue()
+            gzipped = True
+        else:
+            gzipped = False
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        if gzipped:
+            self.send_header('Content-Encoding', 'gzip')
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.record(len(body))
+
+    def do_GET(self):
+        path, _, query = self.path.partition('?')
+        args = dict(arg.partition('=')[::2] for arg in query.split('&'))
+        data = self.server.data
+        if path == '/_stats':
+            server = self.server
+            with server.lock:
+                stats = {'requests': server.requests,
+                         'bytes_sent': server.bytes_sent}
+            return self.send_body(200, json.dumps(stats), 'application/json')
+        elif path != '/report':
+            return self.send_body(404, 'Not Found')
+        if args.get('format') == 'tab':
+            return self.send_body(200, data.report_tab())
+        elif args.get('format') == 'sql':
+            try:
+                sql = data.report_sql(int(args.get('id')))
+            except (KeyError, ValueError, TypeError):
+                return self.send_body(404, 'No such report')
+            return self.send_body(200, sql.encode('utf8'))
+        self.send_body(400, 'Unsupported format')
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('content-length', 0)))
+        if self.headers.get('content-encoding') == 'gzip':
+            body = gzip.GzipFile(fileobj=StringIO(body)).read()
+        path, _, query = self.path.partition('?')
+        if path == '/_touch':
+            args = dict(arg.partition('=')[::2] for arg in query.split('&'))
+            ids = self.server.data.touch(int(args.get('count', 1)))
+            return self.send_body(200, json.dumps(ids), 'application/json')
+        elif path != '/login/jsonrpc':
+            return self.send_body(404, 'Not Found')
+        req = json.loads(body, object_hook=jsonclass_hook)
+        data = self.server.data
+        try:
+            if req['method'] == 'system.multicall':
+                result = [self.call(data, **call) for call in req['params']]
+            else:
+                result = data.dispatch(req['method'], req['params'])
+            res = {'id': req.get('id'), 'error': None, 'result': result}
+        except Exception, e:
+            res = {'id': req.get('id'), 'result': None,
+                   'error': {'name': 'JSONRPCError', 'code': -32603,
+                             'message': repr(e)}}
+        self.send_body(200, json.dumps(res), 'application/json')
+
+    def call(self, data, method, params, id=None):
+        try:
+            return {'id': id, 'error': None,
+                    'result': data.dispatch(method, params)}
+        except Exception, e:
+            return {'id': id, 'result': None,
+                    'error': {'name': 'JSONRPCError', 'code': -32603,
+                              'message': repr(e)}}
+
+
+class FakeTracServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """HTTP server for a ``FakeTracData``, with ``latency`` seconds added
+    to every response. Counts requests and response bytes.
+
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, data, address=('127.0.0.1', 0), latency=0.0,
+                 verbose=False):
+        BaseHTTPServer.HTTPServer.__init__(self, address, FakeTracHandler)
+        self.data = data
+        self.latency = latency
+        self.verbose = verbose
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.bytes_sent = 0
+
+    @property
+    def url(self):
+        return 'http://%s:%d' % self.server_address
+
+    def record(self, nbytes):
+        with self.lock:
+            self.requests += 1
+            self.bytes_sent += nbytes
+
+    def start(self):
+        """Serve forever on a daemon thread"""
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+
+def serve_child(queue, kw, latency):
+    """``multiprocessing`` target: serve ``FakeTracData(**kw)`` and put
+    ``(url, ticket_count)`` on ``queue`` once listening.
+
+    """
+    data = FakeTracData(**kw)
+    server = FakeTracServer(data, latency=latency)
+    queue.put((server.url, len(data.tickets)))
+    server.serve_forever()
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('-p', '--port', type='int', default=8000)
+    parser.add_option('-t', '--tickets', type='int', default=1000)
+    parser.add_option('-c', '--changes', type='int', default=5,
+                      help='change groups per ticket (default: %default)')
+    parser.add_option('-l', '--latency', type='float', default=0.0,
+                      help='seconds added to each response '
+                           '(default: %default)')
+    parser.add_option('--whole-seconds', action='store_true', default=False,
+                      help='keep every time to the second, so that '
+                           'ticket.changeLog(id, when) finds them')
+    parser.add_option('-v', '--verbose', action='store_true', default=False)
+    (options, _args) = parser.parse_args(argv)
+    data = FakeTracData(tickets=options.tickets, changes=options.changes,
+                        whole_seconds=options.whole_seconds)
+    server = FakeTracServer(data, ('127.0.0.1', options.port),
+                            latency=options.latency, verbose=options.verbose)
+    print 'serving fake Trac with %d tickets at %s' % (
+        len(data.tickets), server.url)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
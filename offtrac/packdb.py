@@ -0,0 +1,509 @@
+#!/usr/bin/env python
+"""
+Packed storage for the JSON file database.
+
+``PackedDB`` keeps the documents under ``PACKED_DIRS`` (``ticket/`` and
+``changelog/``) in append-only segment files under ``db/pack/`` instead of
+one file each, with an index from path to segment offset. Everything else
+(reports, fields, ``db.json``) stays a plain file in git. The pack itself is
+not committed. Each checkpoint writes the pack sequence number to
+``db/pack.json``, which is committed, so ``changed_files`` can still work
+from a git revision.
+
+Segment files are a series of records::
+
+    {{path}} {{length}}\\n{{length bytes of canonical JSON}}\\n
+
+so they can be scanned without the index. Replaced and deleted records stay
+in the segments until ``compact`` rewrites the live ones.
+
+Runs with ``python -mofftrac.packdb import|export|compact|stats``.
+
+"""
+from __future__ import with_statement
+
+import os
+import sys
+import time
+import fcntl
+import optparse
+import threading
+
+import simplejson as json
+
+from . import dumptrac
+from .dumptrac import (DB, Change, dump_json, expand_renames, write_stats,
+                       DEFAULT_PATH, IGNORES)
+
+PACKED_DIRS = ('ticket', 'changelog')
+PACK_DIR = 'pack'
+PACK_VERSION = 1
+SEGMENT_SIZE = 64 * 1024 * 1024
+
+
+def segment_name(n):
+    return 'segment-%06d.dat' % (n,)
+
+
+def is_packed(relpath):
+    return relpath.partition('/')[0] in PACKED_DIRS
+
+
+class Pack(object):
+    """Append-only segment files plus an in-memory index, persisted by
+    ``flush``.
+
+    The index maps a path to ``[segment, offset, length, seq, created]``
+    where ``seq`` is the sequence number of the write that stored it and
+    ``created`` the one that first added the path. Deleted paths are kept
+    as tombstones ``[seq, created]`` so that deletions can be found.
+
+    Any number of processes can read a pack. The first change after a
+    ``flush`` takes ``write.lock`` until the next one, so there is only one
+    writer at a time.
+
+    """
+    def __init__(self, root, segment_size=SEGMENT_SIZE):
+        self.root = root
+        self.segment_size = segment_size
+        self.lock = threading.Lock()
+        self.seq = 0
+        self.records = {}
+        self.tombstones = {}
+        self.segment = 1
+        # Size of the tail segment in the index that was read
+        self.tail_size = 0
+        self.tail = None
+        # The open write.lock once this process may change the pack
+        self.write_lock = None
+        self.index_stat = None
+        self.read_index()
+
+    def path_join(self, *args):
+        return os.path.join(self.root, *args)
+
+    @property
+    def index_path(self):
+        return self.path_join('index.json')
+
+    def exists(self):
+        return os.path.exists(self.index_path)
+
+    def stat_index(self, st=None):
+        if st is None:
+            try:
+                st = os.stat(self.index_path)
+            except OSError:
+                return None
+        return st.st_ino, st.st_size, st.st_mtime
+
+    def read_index(self):
+        try:
+            with open(self.index_path, 'rb') as f:
+                self.index_stat = self.stat_index(os.fstat(f.fileno()))
+                index = json.load(f)
+        except IOError:
+            return
+        if index['version'] != PACK_VERSION:
+            raise dumptrac.DBError(
+                "Pack version {} not supported".format(index['version']))
+        self.seq = index['seq']
+        self.records = index['records']
+        self.tombstones = index['tombstones']
+        self.segment, self.tail_size = index['tail']
+
+    def lock_for_write(self):
+        """Take ``write.lock`` before the first change since the last
+        ``flush``, raises ``DBError`` if another writer holds it. Must be
+        called with the lock held.
+
+        """
+        if self.write_lock is not None:
+            return
+        if not os.path.exists(self.root):
+            os.makedirs(self.root)
+        f = open(self.path_join('write.lock'), 'ab')
+        try:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            f.close()
+            raise dumptrac.DBError(
+                "Pack {} is being written by another process".format(
+                    self.root))
+        self.write_lock = f
+        # A writer may have flushed since the index was read
+        if self.stat_index() != self.index_stat:
+            self.read_index()
+        # Drop whatever the last writer appended after its last flush
+        fn = self.path_join(segment_name(self.segment))
+        if os.path.exists(fn) and os.path.getsize(fn) > self.tail_size:
+            with open(fn, 'r+b') as f:
+                f.truncate(self.tail_size)
+
+    def flush(self):
+        with self.lock:
+            if self.write_lock is None:
+                # Nothing was changed by this process
+                return
+            if self.tail is not None:
+                self.tail.flush()
+                os.fsync(self.tail.fileno())
+            fn = self.path_join(segment_name(self.segment))
+            size = os.path.getsize(fn) if os.path.exists(fn) else 0
+            # Compact, unlike the canonical JSON of the documents: this is
+            # rewritten at every checkpoint and read at every start
+            s = json.dumps({
+                'version': PACK_VERSION,
+                'seq': self.seq,
+                'records': self.records,
+                'tombstones': self.tombstones,
+                'tail': [self.segment, size],
+            }, separators=(',', ':'))
+            tmpfn = self.path_join('.index.json')
+            with open(tmpfn, 'wb') as f:
+                f.write(s)
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(tmpfn, self.index_path)
+            self.tail_size = size
+            self.index_stat = self.stat_index()
+            if self.tail is not None:
+                self.tail.close()
+                self.tail = None
+            self.write_lock.close()
+            self.write_lock = None
+
+    def close(self):
+        self.flush()
+
+    def append(self, relpath, s):
+        """Append a record to the current segment, returns its location.
+        Must be called with the lock held.
+
+        """
+        if self.tail is None:
+            self.lock_for_write()
+            self.tail = open(self.path_join(segment_name(self.segment)), 'ab')
+        self.tail.seek(0, os.SEEK_END)
+        offset = self.tail.tell()
+        if offset and offset + len(s) > self.segment_size:
+            self.tail.close()
+            self.segment += 1
+            self.tail = open(self.path_join(segment_name(self.segment)), 'ab')
+            offset = 0
+        header = '%s %d\n' % (relpath, len(s))
+        self.tail.write(header + s + '\n')
+        return self.segment, offset + len(header)
+
+    def read(self, segment, offset, length):
+        if self.tail is not None and segment == self.segment:
+            self.tail.flush()
+        with open(self.path_join(segment_name(segment)), 'rb') as f:
+            f.seek(offset)
+            return f.read(length)
+
+    def get(self, relpath):
+        with self.lock:
+            segment, offset, length, _seq, _created = self.records[relpath]
+            return self.read(segment, offset, length)
+
+    def put(self, relpath, s, if_changed=False):
+        """Store ``s`` at ``relpath``, returns False if ``if_changed`` and
+        the stored bytes are the same.
+
+        """
+        with self.lock:
+            self.lock_for_write()
+            old = self.records.get(relpath)
+            if (if_changed and old is not None and old[2] == len(s) and
+                    self.read(*old[:3]) == s):
+                return False
+            if old is not None:
+                created = old[4]
+            elif relpath in self.tombstones:
+                created = self.tombstones.pop(relpath)[1]
+            else:
+                created = self.seq + 1
+            self.seq += 1
+            segment, offset = self.append(relpath, s)
+            self.records[relpath] = [segment, offset, len(s),
+                                     self.seq, created]
+            return True
+
+    def delete(self, relpath):
+        with self.lock:
+            self.lock_for_write()
+            old = self.records.pop(relpath)
+            self.seq += 1
+            self.tombstones[relpath] = [self.seq, old[4]]
+
+    def paths(self, dirname):
+        prefix = dirname.rstrip('/') + '/'
+        return [relpath for relpath in self.records
+                if relpath.startswith(prefix)]
+
+    def scan(self, dirname):
+        """Yield ``(relpath, bytes)`` for the records under ``dirname``,
+        reading each segment sequentially.
+
+        """
+        with self.lock:
+            if self.tail is not None:
+                self.tail.flush()
+            locations = sorted((record[:3], relpath)
+                               for relpath, record in self.records.iteritems()
+                               if is_under(relpath, dirname))
+        f = None
+        segment = None
+        try:
+            for (rec_segment, offset, length), relpath in locations:
+                if rec_segment != segment:
+                    if f is not None:
+                        f.close()
+                    segment = rec_segment
+                    f = open(self.path_join(segment_name(segment)), 'rb')
+                if f.tell() != offset:
+                    f.seek(offset)
+                yield relpath, f.read(length)
+        finally:
+            if f is not None:
+                f.close()
+
+    def changes_since(self, seq):
+        """Yield ``(modes, relpath)`` like ``DB.changed_files`` for every
+        path written or deleted after sequence number ``seq``.
+
+        """
+        with self.lock:
+            changes = []
+            for relpath, record in self.records.iteritems():
+                if record[3] > seq:
+                    changes.append(('A' if record[4] > seq else 'M', relpath))
+            for relpath, (del_seq, created) in self.tombstones.iteritems():
+                if del_seq > seq and created <= seq:
+                    changes.append(('D', relpath))
+        changes.sort(key=lambda change: change[1])
+        return changes
+
+    def compact(self):
+        """Rewrite the live records into new segments ordered by path and
+        remove the old segments. Returns ``(old_bytes, new_bytes)``.
+
+        """
+        with self.lock:
+            self.lock_for_write()
+            if self.tail is not None:
+                self.tail.close()
+                self.tail = None
+            old_segments = sorted(fn for fn in os.listdir(self.root)
+                                  if fn.startswith('segment-'))
+            old_bytes = sum(os.path.getsize(self.path_join(fn))
+                            for fn in old_segments)
+            first = self.segment + 1
+            self.segment = first
+            records = {}
+            for relpath in sorted(self.records, key=path_sort_key):
+                segment, offset, length, seq, created = self.records[relpath]
+                s = self.read(segment, offset, length)
+                segment, offset = self.append(relpath, s)
+                records[relpath] = [segment, offset, length, seq, created]
+            self.records = records
+            self.tail.flush()
+            os.fsync(self.tail.fileno())
+        self.flush()
+        # The new index no longer refers to the old segments
+        for fn in old_segments:
+            os.remove(self.path_join(fn))
+        new_bytes = sum(os.path.getsize(self.path_join(segment_name(n)))
+                        for n in xrange(first, self.segment + 1))
+        return old_bytes, new_bytes
+
+    def stats(self):
+        segments = [fn for fn in os.listdir(self.root)
+                    if fn.startswith('segment-')]
+        live = sum(record[2] for record in self.records.itervalues())
+        total = sum(os.path.getsize(self.path_join(fn)) for fn in segments)
+        return {'records': len(self.records),
+                'tombstones': len(self.tombstones),
+                'segments': len(segments),
+                'live_bytes': live,
+                'segment_bytes': total,
+                'seq': self.seq}
+
+
+def is_under(relpath, dirname):
+    return relpath.startswith(dirname.rstrip('/') + '/')
+
+
+def path_sort_key(relpath):
+    """Sort ticket ids numerically within a directory"""
+    dirname, _, basename = relpath.rpartition('/')
+    name = basename.rpartition('.')[0]
+    return (dirname, int(name) if name.isdigit() else sys.maxint, name)
+
+
+class PackedDB(DB):
+    """``DB`` that stores ``PACKED_DIRS`` in a ``Pack``. Has the same
+    ``load_json``/``iter_jsondir``/``changed_files`` interface, paths under
+    packed directories are only virtual.
+
+    """
+    ignores = IGNORES + (PACK_DIR + '/',)
+
+    def __init__(self, root=DEFAULT_PATH):
+        DB.__init__(self, root)
+        self.pack = Pack(self.path_join(PACK_DIR))
+
+    def checkpoint(self, message=None):
+        # The pack must be durable before the commit that refers to it
+        self.pack.flush()
+        self.write_json(self.path_join('pack.json'),
+                        {'seq': self.pack.seq}, if_changed=True)
+        DB.checkpoint(self, message)
+
+    def write_json(self, fn, data, if_changed=False):
+        relpath = self.relpath(fn)
+        if not is_packed(relpath):
+            return DB.write_json(self, fn, data, if_changed)
+        self.mark_unclean()
+        written = self.pack.put(relpath, dump_json(data), if_changed)
+        write_stats.count(written)
+        return written
+
+    def remove(self, fn):
+        relpath = self.relpath(fn)
+        if not is_packed(relpath):
+            return DB.remove(self, fn)
+        self.mark_unclean()
+        try:
+            self.pack.delete(relpath)
+        except KeyError:
+            raise OSError("No such packed file: {!r}".format(relpath))
+
+    def json_glob(self, *args):
+        if len(args) == 1 and args[0] in PACKED_DIRS:
+            return [self.path_join(relpath)
+                    for relpath in self.pack.paths(args[0])]
+        return DB.json_glob(self, *args)
+
+    def load_json(self, fn):
+        if is_packed(fn):
+            return json.loads(self.pack.get(fn))
+        return DB.load_json(self, fn)
+
+    def iter_jsondir(self, dirname, jobs=None, transform=None):
+        if dirname not in PACKED_DIRS:
+            return DB.iter_jsondir(self, dirname, jobs, transform)
+        # Segments are still read sequentially here, only decoding is
+        # spread over the pool
+        items = ((self.path_join(relpath), s, transform)
+                 for relpath, s in self.pack.scan(dirname))
+        return dumptrac.parallel_imap(dumptrac.transform_json, items, jobs)
+
+    def iter_json_files(self, fns, jobs=None, transform=None):
+        if len(fns) < dumptrac.DECODE_CHUNKSIZE:
+            jobs = None
+        return dumptrac.parallel_imap(
+            dumptrac.transform_json, self._json_items(fns, transform), jobs)
+
+    def _json_items(self, fns, transform):
+        for fn in fns:
+            relpath = self.relpath(fn)
+            s = self.pack.get(relpath) if is_packed(relpath) else None
+            yield fn, s, transform
+
+    def pack_seq_at(self, ver):
+        """The pack sequence number committed in revision ``ver``"""
+        (rc, stdout, _stderr) = dumptrac.call(
+            [dumptrac.GIT, 'show', '{}:pack.json'.format(ver)], cwd=self.root)
+        if rc:
+            return 0
+        return json.loads(stdout)['seq']
+
+    def iter_changes(self, ver):
+        existed = set()
+        for change in expand_renames(DB.iter_changes(self, ver)):
+            if is_packed(change.path):
+                # Only across an import: the file is in the pack now
+                if change.status != 'A':
+                    existed.add(change.path)
+                if change.path in self.pack.records:
+                    continue
+            yield change
+        for modes, relpath in self.pack.changes_since(self.pack_seq_at(ver)):
+            if modes == 'A' and relpath in existed:
+                modes = 'M'
+            yield Change(modes, relpath, None, None)
+
+    def import_files(self):
+        """Move the per-file documents of ``PACKED_DIRS`` into the pack"""
+        count = 0
+        for dirname in PACKED_DIRS:
+            for fn in DB.json_glob(self, dirname):
+                with open(fn, 'rb') as f:
+                    s = f.read()
+                self.pack.put(self.relpath(fn), s)
+                DB.remove(self, fn)
+                count += 1
+        return count
+
+    def export_files(self):
+        """Write every packed document back to its own file and remove the
+        pack, the database is then a plain ``DB``.
+
+        """
+        self.mark_unclean()
+        count = 0
+        for dirname in PACKED_DIRS:
+            if not os.path.exists(self.path_join(dirname)):
+                os.makedirs(self.path_join(dirname))
+            for relpath, s in self.pack.scan(dirname):
+                fn = self.path_join(relpath)
+                with open(fn, 'wb') as f:
+                    f.write(s)
+                if self.dirty is not None:
+                    self.dirty.add(relpath)
+                count += 1
+        return count
+
+
+def has_pack(root):
+    return os.path.exists(os.path.join(root, PACK_DIR, 'index.json'))
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(
+        usage='%prog [options] import|export|compact|stats')
+    parser.add_option('-d', '--db', default=DEFAULT_PATH,
+                      help='file database directory (default: %default)')
+    (options, args) = parser.parse_args(argv)
+    if len(args) != 1 or args[0] not in ('import', 'export',
+                                         'compact', 'stats'):
+        parser.error('expected one of import, export, compact or stats')
+    command = args[0]
+    db = PackedDB(options.db)
+    db.init()
+    t0 = time.time()
+    if command == 'import':
+        print 'packed {} files'.format(db.import_files())
+        db.checkpoint('pack {}'.format(', '.join(PACKED_DIRS)))
+    elif command == 'export':
+        count = db.export_files()
+        db.pack.close()
+        for fn in os.listdir(db.pack.root):
+            os.remove(db.pack.path_join(fn))
+        os.rmdir(db.pack.root)
+        db.remove(db.path_join('pack.json'))
+        DB.checkpoint(db, 'unpack {}'.format(', '.join(PACKED_DIRS)))
+        print 'unpacked {} files'.format(count)
+    elif command == 'compact':
+        old_bytes, new_bytes = db.pack.compact()
+        print 'compacted {} bytes into {} bytes'.format(old_bytes, new_bytes)
+    else:
+        for k, v in sorted(db.pack.stats().iteritems()):
+            print '{}: {}'.format(k, v)
+    print 'took {:.2f}s'.format(time.time() - t0)
+
+
+if __name__ == '__main__':
+    main()
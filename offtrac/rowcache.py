@@ -0,0 +1,153 @@
+"""
+A persistent cache of the rows ``offtrac.etl`` builds from each JSON file
+in the file database, so a full reindex only parses and converts the files
+that changed since the last one.
+
+Entries are keyed by the path of the file and its git blob id, the value is
+the list of row dicts for the file (after ``iso8601_to_trac_time`` and
+friends) serialized with ``marshal``. The cache lives in
+``./db/offtrac-cache.db`` (ignored by git like ``offtrac.db``) and is
+bounded by size, the least recently used entries are evicted on close.
+
+"""
+from __future__ import with_statement
+
+import marshal
+import sqlite3
+
+from .dumptrac import chunked
+
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+# SQLite's default limit on host parameters is 999
+LOOKUP_SIZE = 400
+PUT_BATCH = 1000
+
+SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS meta ('
+    ' key TEXT PRIMARY KEY,'
+    ' value TEXT)',
+    'CREATE TABLE IF NOT EXISTS rows ('
+    ' path TEXT NOT NULL,'
+    ' blob TEXT NOT NULL,'
+    ' data BLOB NOT NULL,'
+    ' size INTEGER NOT NULL,'
+    ' used INTEGER NOT NULL,'
+    ' PRIMARY KEY (path, blob))',
+    'CREATE INDEX IF NOT EXISTS rows_used_idx ON rows (used)',
+)
+
+
+class RowCache(object):
+    """Rows keyed by ``(path, blob)``. ``version`` identifies the code that
+    built the rows, the cache is emptied when it changes.
+
+    """
+    def __init__(self, path, version, max_bytes=DEFAULT_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.conn = sqlite3.connect(path)
+        self.conn.text_factory = str
+        for statement in SCHEMA:
+            self.conn.execute(statement)
+        row = self.conn.execute(
+            "SELECT value FROM meta WHERE key = 'version'").fetchone()
+        if row is None or row[0] != str(version):
+            self.conn.execute('DELETE FROM rows')
+            self.conn.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES "
+                "('version', ?)", (str(version),))
+        self.conn.commit()
+        # Incremented for every lookup batch, entries with the lowest
+        # ``used`` are evicted first
+        self.clock = self.conn.execute(
+            'SELECT COALESCE(MAX(used), 0) FROM rows').fetchone()[0]
+        self.pending = []
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+
+    def _select(self, columns, keys):
+        paths = list(set(path for path, _blob in keys))
+        wanted = set(keys)
+        for group in chunked(paths, LOOKUP_SIZE):
+            sql = 'SELECT path, blob{} FROM rows WHERE path IN ({})'.format(
+                columns, ','.join('?' * len(group)))
+            for row in self.conn.execute(sql, group):
+                if (row[0], row[1]) in wanted:
+                    yield row
+
+    def contains(self, keys):
+        """The subset of ``keys`` that have cached rows"""
+        found = set((path, blob) for path, blob in self._select('', keys))
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+        return found
+
+    def get_many(self, keys):
+        """Map each cached key of ``keys`` to its rows"""
+        self.clock += 1
+        found = {}
+        for path, blob, data in self._select(', data', keys):
+            found[(path, blob)] = marshal.loads(str(data))
+        if found:
+            self.conn.executemany(
+                'UPDATE rows SET used = ? WHERE path = ? AND blob = ?',
+                [(self.clock, path, blob) for path, blob in found])
+        return found
+
+    def get(self, key):
+        rows = self.get_many([key]).get(key)
+        if rows is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return rows
+
+    def put(self, key, rows):
+        path, blob = key
+        data = marshal.dumps(rows)
+        self.pending.append(
+            (path, blob, buffer(data), len(data), self.clock))
+        if len(self.pending) >= PUT_BATCH:
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO rows (path, blob, data, size, used) '
+                'VALUES (?, ?, ?, ?, ?)', self.pending)
+            self.pending = []
+        self.conn.commit()
+
+    def size(self):
+        return self.conn.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM rows').fetchone()[0]
+
+    def evict(self):
+        """Drop the least recently used entries until the cache fits in
+        ``max_bytes``
+
+        """
+        excess = self.size() - self.max_bytes
+        if excess <= 0:
+            return
+        victims = []
+        for path, blob, size in self.conn.execute(
+                'SELECT path, blob, size FROM rows ORDER BY used'):
+            victims.append((path, blob))
+            excess -= size
+            if excess <= 0:
+                break
+        self.conn.executemany(
+            'DELETE FROM rows WHERE path = ? AND blob = ?', victims)
+        self.evicted += len(victims)
+        self.conn.commit()
+
+    def report(self):
+        return 'row cache: {} hits, {} misses, {} evicted, {:.1f} MiB'.format(
+            self.hits, self.misses, self.evicted, self.size() / 1048576.0)
+
+    def close(self):
+        self.flush()
+        self.evict()
+        self.conn.close()